@@ -7,8 +7,12 @@ import torch.nn as nn
 from collections import defaultdict
 from torchvision.utils import save_image
 from config import args, DirsAndLocksSingleton
-from model_ddpg import DuelNet, PiNet, SplineNet, MultipleOptimizer
+from model_ddpg import DuelNet, PiNet, SplineNet, MultipleOptimizer, StackedDuelNet, StackedSplineNet, Ensemble
+from replay_buffer import ReplayBuffer
+from samplers import build_sampler
+from checkpoint_writer import CheckpointWriter
 import math
+import random
 import os
 import copy
 import shutil
@@ -19,8 +23,11 @@ class Agent(object):
         self.cuda_id = args.cuda_default
         use_cuda = not args.no_cuda and torch.cuda.is_available()
         self.device = torch.device("cuda" if use_cuda else "cpu")
+        self.dtype = torch.float
         self.action_space = args.action_space
         self.env = env
+        self.env.device = self.device
+        self.env.dtype = self.dtype
         self.dirs_locks = DirsAndLocksSingleton(exp_name)
 
         self.use_trust_region = args.trust_region
@@ -32,6 +39,16 @@ class Agent(object):
         self.value_lr = args.value_lr
         self.budget = args.budget
         self.checkpoint = checkpoint
+        # the checkpoints of every problem rotate separately and are written in the background
+        self.checkpoint_writer = CheckpointWriter.shared(self.dirs_locks.checkpoints_dir, args.checkpoint_keep)
+        self.checkpoint_name = 'problem_{}'.format(self.problem_index)
+        # with --load-last-model the problem continues from its latest checkpoint, a new run drops the old ones
+        self.resume_checkpoint = self.checkpoint_writer.latest(self.checkpoint_name) if args.load_last_model else None
+        if self.resume_checkpoint is None:
+            self.checkpoint_writer.remove(self.checkpoint_name)
+            if env.trace is not None:
+                # the trace of the problem is continued only along with a checkpoint
+                env.trace.truncate(0)
         self.algorithm_method = args.algorithm
         self.grad_clip = args.grad_clip
         self.req_lambda = 1e-3
@@ -40,16 +57,19 @@ class Agent(object):
         self.printing_interval = args.printing_interval
         self.analysis_dir = os.path.join(self.dirs_locks.analysis_dir, str(self.problem_index))
         if os.path.exists(self.analysis_dir):
-            shutil.rmtree(self.analysis_dir, ignore_errors=True)
-            os.makedirs(self.analysis_dir)
+            if self.resume_checkpoint is None:
+                shutil.rmtree(self.analysis_dir, ignore_errors=True)
+                os.makedirs(self.analysis_dir)
         else:
             os.makedirs(self.analysis_dir)
 
         self.frame = 0
         self.n_offset = 0
         self.results = defaultdict(list)
-        self.tensor_replay_reward = torch.cuda.FloatTensor([])
-        self.tensor_replay_policy = torch.cuda.FloatTensor([])
+        self.replay = ReplayBuffer(self.replay_memory_size, self.action_space, self.n_explore, self.device, self.dtype)
+        # minibatch sampling stays on the device, seeded from the global generator so --seed still applies
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(int(torch.randint(2 ** 62, (1,))))
         self.pi_lr = args.pi_lr
         self.epsilon = args.epsilon * math.sqrt(self.action_space)
         self.delta = self.pi_lr
@@ -58,12 +78,16 @@ class Agent(object):
         self.alpha = args.alpha
         self.epsilon_factor = args.epsilon_factor
         self.spline = args.spline
+        self.ensemble = args.ensemble
+        self.ensemble_shape = (self.ensemble,) if self.ensemble > 1 else ()
 
-        if args.explore == 'rand':
+        explore = args.explore.split('-')[-1]
+        self.sampler = build_sampler(args.explore, self.action_space, self.device, self.dtype, pool=args.sample_pool)
+        if explore == 'rand':
             self.exploration = self.exploration_rand
-        elif args.explore == 'ball':
+        elif explore == 'ball':
             self.exploration = self.ball_explore
-        elif args.explore == 'cone':
+        elif explore == 'cone':
             if self.action_space == 1:
                 self.exploration = self.exploration_rand
             else:
@@ -73,42 +97,17 @@ class Agent(object):
             print("explore:" + args.explore)
             raise NotImplementedError
 
-        self.init = torch.FloatTensor(self.env.get_initial_solution()).to(self.device)
+        self.init = torch.tensor(self.env.get_initial_solution(), dtype=self.dtype, device=self.device)
         self.pi_net = PiNet(self.init, self.device, self.action_space)
         self.optimizer_pi = torch.optim.SGD([self.pi_net.pi], lr=self.pi_lr)
         self.pi_net.eval()
 
         self.value_iter = args.learn_iteration
         if self.algorithm_method in ['EGL']:
-            if self.spline:
-                self.derivative_net = SplineNet(self.device, self.pi_net, output=self.action_space)
-                self.derivative_net.to(self.device)
-                # IT IS IMPORTANT TO ASSIGN MODEL TO CUDA/PARALLEL BEFORE DEFINING OPTIMIZER
-                opt_sparse = torch.optim.SparseAdam(self.derivative_net.embedding.parameters(), lr=0.1, betas=(0.9, 0.999), eps=1e-04)
-                opt_dense = torch.optim.Adam(self.derivative_net.head.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-04)
-                self.optimizer_derivative = MultipleOptimizer(opt_sparse, opt_dense)
-            else:
-                self.derivative_net = DuelNet(self.pi_net, self.action_space)
-                self.derivative_net.to(self.device)
-                # IT IS IMPORTANT TO ASSIGN MODEL TO CUDA/PARALLEL BEFORE DEFINING OPTIMIZER
-                self.optimizer_derivative = torch.optim.Adam(self.derivative_net.parameters(), lr=self.value_lr, eps=1.5e-4, weight_decay=0)
-            self.derivative_net.eval()
+            self.derivative_net, self.optimizer_derivative = self.build_surrogate(self.action_space)
             self.derivative_net_zero = copy.deepcopy(self.derivative_net.state_dict())
         elif self.algorithm_method == 'IGL':
-            if self.spline:
-                self.value_net = SplineNet(self.device, self.pi_net, output=1)
-                self.value_net.to(self.device)
-                # IT IS IMPORTANT TO ASSIGN MODEL TO CUDA/PARALLEL BEFORE DEFINING OPTIMIZER
-                opt_sparse = torch.optim.SparseAdam(self.value_net.embedding.parameters(), lr=0.1, betas=(0.9, 0.999), eps=1e-04)
-                opt_dense = torch.optim.Adam(self.value_net.head.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-04)
-                self.optimizer_value = MultipleOptimizer(opt_sparse, opt_dense)
-            else:
-                self.value_net = DuelNet(self.pi_net, 1)
-                self.value_net.to(self.device)
-                # IT IS IMPORTANT TO ASSIGN MODEL TO CUDA/PARALLEL BEFORE DEFINING OPTIMIZER
-                self.optimizer_value = torch.optim.Adam(self.value_net.parameters(), lr=self.value_lr, eps=1.5e-4, weight_decay=0)
-
-            self.value_net.eval()
+            self.value_net, self.optimizer_value = self.build_surrogate(1)
             self.value_net_zero = copy.deepcopy(self.value_net.state_dict())
         else:
             raise NotImplementedError
@@ -120,6 +119,33 @@ class Agent(object):
         else:
             raise NotImplementedError
 
+    def build_surrogate(self, output):
+        # with an ensemble the members are stacked in a single net and share its optimizers, the optimizers are
+        # elementwise so every member is updated as a separate model
+        if self.spline:
+            if self.ensemble > 1:
+                net = Ensemble(StackedSplineNet(self.device, self.ensemble, output=output), self.ensemble)
+                spline_net = net.net
+            else:
+                net = SplineNet(self.device, self.pi_net, output=output)
+                spline_net = net
+            net.to(self.device)
+            # IT IS IMPORTANT TO ASSIGN MODEL TO CUDA/PARALLEL BEFORE DEFINING OPTIMIZER
+            opt_sparse = torch.optim.SparseAdam(spline_net.embedding.parameters(), lr=0.1, betas=(0.9, 0.999), eps=1e-04)
+            opt_dense = torch.optim.Adam(spline_net.head.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-04)
+            optimizer = MultipleOptimizer(opt_sparse, opt_dense)
+        else:
+            if self.ensemble > 1:
+                net = Ensemble(StackedDuelNet([DuelNet(self.pi_net, output) for _ in range(self.ensemble)]), self.ensemble)
+            else:
+                net = DuelNet(self.pi_net, output)
+            net.to(self.device)
+            # IT IS IMPORTANT TO ASSIGN MODEL TO CUDA/PARALLEL BEFORE DEFINING OPTIMIZER
+            optimizer = torch.optim.Adam(net.parameters(), lr=self.value_lr, eps=1.5e-4, weight_decay=0)
+
+        net.eval()
+        return net, optimizer
+
     def reset_result(self):
         self.results = defaultdict(list)
 
@@ -158,8 +184,8 @@ class Agent(object):
                 np.save(path, tmp)
 
         best_list, observed_list, _ = self.env.get_observed_and_pi_list()
-        np.save(os.path.join(self.analysis_dir, 'best_list_with_explore.npy'), np.array(best_list))
-        np.save(os.path.join(self.analysis_dir, 'observed_list_with_explore.npy'), np.array(best_list))
+        np.save(os.path.join(self.analysis_dir, 'best_list_with_explore.npy'), best_list)
+        np.save(os.path.join(self.analysis_dir, 'observed_list_with_explore.npy'), best_list)
 
         path = os.path.join(self.analysis_dir, 'f0.npy')
         np.save(path, self.env.get_f0())
@@ -168,38 +194,84 @@ class Agent(object):
             path = os.path.join(self.analysis_dir, 'reconstruction.png')
             save_image(self.pi_net.pi.cpu().view(1, 28, 28), path)
 
-    def save_checkpoint(self, path, aux=None):
+    def rng_state(self):
+        state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate(),
+                 'generator': self.generator.get_state()}
+        if self.device.type == 'cuda':
+            state['cuda'] = torch.cuda.get_rng_state(self.device)
+        return state
+
+    def load_rng_state(self, state):
+        # the states are byte tensors of the host whatever the map_location of the checkpoint
+        torch.set_rng_state(state['torch'].cpu())
+        np.random.set_state(state['numpy'])
+        random.setstate(state['random'])
+        self.generator.set_state(state['generator'].cpu())
+        if 'cuda' in state and self.device.type == 'cuda':
+            torch.cuda.set_rng_state(state['cuda'].cpu(), self.device)
+
+    def state_dict(self):
+        # everything a problem needs to continue mid-budget, the surrogate keys are those of the former checkpoints
+        state = {'pi_net': self.pi_net.pi.detach(),
+                 'optimizer_pi': self.optimizer_pi.state_dict(),
+                 'pi_lr': self.pi_lr,
+                 'epsilon': self.epsilon,
+                 'divergence': self.divergence,
+                 'frame': self.frame,
+                 'mean_grad': self.mean_grad,
+                 'replay': self.replay.state_dict(),
+                 'sampler': self.sampler.state_dict(),
+                 'env': self.env.state_dict(),
+                 'rng': self.rng_state()}
         if self.algorithm_method in ['EGL']:
-            state = {'pi_net': self.pi_net.pi.detach(),
-                     'derivative_net': self.derivative_net.state_dict(),
-                     'optimizer_derivative': self.optimizer_derivative.state_dict(),
-                     'optimizer_pi': self.optimizer_pi.state_dict(),
-                     'aux': aux}
+            state['derivative_net'] = self.derivative_net.state_dict()
+            state['derivative_net_zero'] = self.derivative_net_zero
+            state['optimizer_derivative'] = self.optimizer_derivative.state_dict()
         elif self.algorithm_method == 'IGL':
-            state = {'pi_net': self.pi_net.pi.detach(),
-                     'value_net': self.value_net.state_dict(),
-                     'optimizer_value': self.optimizer_value.state_dict(),
-                     'optimizer_pi': self.optimizer_pi.state_dict(),
-                     'aux': aux}
+            state['value_net'] = self.value_net.state_dict()
+            state['value_net_zero'] = self.value_net_zero
+            state['optimizer_value'] = self.optimizer_value.state_dict()
         else:
             raise NotImplementedError
+        return state
 
-        torch.save(state, path)
-
-    def load_checkpoint(self, path):
-        if not os.path.exists(path):
-            assert False, "load_checkpoint"
-        state = torch.load(path, map_location="cuda:%d" % self.cuda_id)
-        self.pi_net = state['pi_net'].to(self.device)
+    def load_state_dict(self, state):
+        self.pi_net.pi_update(state['pi_net'])
         self.optimizer_pi.load_state_dict(state['optimizer_pi'])
+        self.pi_lr = state['pi_lr']
+        self.epsilon = state['epsilon']
+        self.divergence = state['divergence']
+        self.frame = state['frame']
+        self.mean_grad = state['mean_grad']
+        self.replay.load_state_dict(state['replay'])
+        self.sampler.load_state_dict(state['sampler'])
+        self.env.load_state_dict(state['env'])
         if self.algorithm_method in ['EGL']:
             self.derivative_net.load_state_dict(state['derivative_net'])
+            self.derivative_net_zero = state['derivative_net_zero']
             self.optimizer_derivative.load_state_dict(state['optimizer_derivative'])
         elif self.algorithm_method == 'IGL':
             self.value_net.load_state_dict(state['value_net'])
+            self.value_net_zero = state['value_net_zero']
             self.optimizer_value.load_state_dict(state['optimizer_value'])
         else:
             raise NotImplementedError
+        self.load_rng_state(state['rng'])
+
+    def save_checkpoint(self, aux=None):
+        state = self.state_dict()
+        state['aux'] = aux
+        self.checkpoint_writer.save(self.checkpoint_name, state)
+
+    def load_checkpoint(self, path=None):
+        # the latest checkpoint of the problem by default
+        if path is None:
+            path = self.checkpoint_writer.latest(self.checkpoint_name)
+        if path is None or not os.path.exists(path):
+            assert False, "load_checkpoint"
+        # the checkpoints hold the numpy and python states besides the tensors
+        state = torch.load(path, map_location=self.device, weights_only=False)
+        self.load_state_dict(state)
         self.n_offset = state['aux']['n']
 
         return state['aux']
@@ -212,33 +284,50 @@ class Agent(object):
             self.value_net.load_state_dict(self.value_net_zero)
             self.optimizer_value.state = defaultdict(dict)
 
-    def get_n_grad_ahead(self, n):
+    def surrogate_grad(self, pi):
+        # the gradient of the surrogate at a batch of policies, neither pi_net nor the optimizers are used
+        if self.algorithm_method in ['EGL']:
+            with torch.no_grad():
+                grad = self.derivative_net(pi).view_as(pi)
+            # replace NaN values with zeros
+            return torch.where(grad != grad, torch.zeros_like(grad), grad)
+        elif self.algorithm_method == 'IGL':
+            with torch.enable_grad():
+                pi = pi.detach().requires_grad_()
+                return torch.autograd.grad(self.value_net(pi).sum(), pi)[0]
+        else:
+            raise NotImplementedError
+
+    def get_n_grad_ahead(self, n, pi=None):
+        # the pi of the next n get_grad(grad_step=True) steps on the current surrogate, from the current pi or from
+        # a batch of starting points (points x action_space, the result is then n+1 x points x action_space).
+        # optimizer_pi is a plain SGD so the steps are computed directly and the agent is left untouched.
+        pi = (self.pi_net.pi if pi is None else pi).detach()
+        single = pi.dim() == 1
+        pi = pi.view(-1, self.action_space)
 
-        optimizer_state = copy.deepcopy(self.optimizer_pi.state_dict())
-        pi_array = [self.pi_net.pi.detach().clone()]
+        pi_array = [pi]
         for _ in range(n):
-            pi, _ = self.get_grad(grad_step=True)
+            grad = self.surrogate_grad(pi)
+            if self.grad_clip != 0:
+                # clip_grad_norm_ of every starting point
+                max_norm = self.epsilon / self.pi_lr
+                grad = grad * torch.clamp(max_norm / (torch.norm(grad, dim=1, keepdim=True) + 1e-6), max=1)
+            pi = pi - self.pi_lr * grad
             pi_array.append(pi)
 
-        self.optimizer_pi.load_state_dict(optimizer_state)
-        self.pi_net.pi_update(pi_array[0].to(self.device))
-
         pi_array = torch.stack(pi_array)
-        return pi_array
+        return pi_array[:, 0] if single else pi_array
 
     def exploration_rand(self, n_explore):
         pi = self.pi_net.pi.detach().clone()
-        rand_sign = (2*torch.randint(0, 2 ,size=(n_explore-1, self.action_space), device=self.device)-1).reshape(n_explore-1, self.action_space)
-        pi_explore = pi - self.epsilon * rand_sign * torch.cuda.FloatTensor(n_explore-1, self.action_space).uniform_()
+        pi_explore = pi - self.epsilon * self.sampler.cube(n_explore-1)
         return torch.cat([pi.unsqueeze(0), pi_explore], dim=0)
 
     def ball_explore_(self, pi, n_explore):
         pi = pi.unsqueeze(0)
 
-        x = torch.cuda.FloatTensor(n_explore, self.action_space).normal_()
-        mag = torch.cuda.FloatTensor(n_explore, 1).uniform_()
-
-        x = x / (torch.norm(x, dim=1, keepdim=True) + 1e-8)
+        x, mag = self.sampler.ball(n_explore)
 
         explore = pi + self.epsilon * mag * x
 
@@ -255,10 +344,8 @@ class Agent(object):
         alpha = math.pi/angle
         pi = pi.unsqueeze(0)
 
-        x = torch.cuda.FloatTensor(n_explore, self.action_space).normal_()
-        mag = torch.cuda.FloatTensor(n_explore, 1).uniform_()
+        x, mag = self.sampler.ball(n_explore)
 
-        x = x / (torch.norm(x, dim=1, keepdim=True) + 1e-8)
         grad = grad / (torch.norm(grad) + 1e-8)
 
         cos = (x @ grad).unsqueeze(1)
@@ -0,0 +1,116 @@
+import os
+import json
+import numpy as np
+
+# The analysis series of a single problem are stored append only: every save writes one chunk file per series
+# (<series>/<chunk>.npy) and replaces the small index.json that lists the chunk lengths, so a save costs the size
+# of the new rows only. The index is written after the chunks, a reader always sees complete chunks.
+
+
+def chunk_path(path, name, i):
+    return os.path.join(path, name, '{:06d}.npy'.format(i))
+
+
+class AnalysisWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+
+    def length(self, name):
+        return sum(self.index.get(name, []))
+
+    def append(self, name, data):
+        data = np.atleast_1d(np.asarray(data))
+        if not len(data):
+            return
+        chunks = self.index.setdefault(name, [])
+        if not chunks:
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        np.save(chunk_path(self.path, name, len(chunks)), data)
+        chunks.append(len(data))
+
+    def flush(self):
+        tmp = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.path, 'index.json'))
+
+
+class LazySeries(object):
+
+    # the chunks of a series seen as one array concatenated along the first axis, a chunk is memory mapped only
+    # when an index touches it
+
+    def __init__(self, paths, lengths):
+        self.paths = paths
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.chunks = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def chunk(self, i):
+        if i not in self.chunks:
+            self.chunks[i] = np.load(self.paths[i], mmap_mode='r')
+        return self.chunks[i]
+
+    @property
+    def shape(self):
+        return (len(self),) + self.chunk(0).shape[1:]
+
+    @property
+    def dtype(self):
+        return self.chunk(0).dtype
+
+    def __getitem__(self, item):
+        rows, rest = (item[0], item[1:]) if isinstance(item, tuple) else (item, ())
+
+        if isinstance(rows, (int, np.integer)):
+            if rows < 0:
+                rows += len(self)
+            if not 0 <= rows < len(self):
+                raise IndexError("index {} is out of bounds for a series of {} rows".format(rows, len(self)))
+            i = int(np.searchsorted(self.offsets, rows, side='right')) - 1
+            return np.array(self.chunk(i)[(rows - self.offsets[i],) + rest])
+
+        rows = np.arange(len(self))[rows]
+        chunk = np.searchsorted(self.offsets, rows, side='right') - 1
+        res = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        for i in np.unique(chunk):
+            index = chunk == i
+            res[index] = self.chunk(i)[rows[index] - self.offsets[i]]
+        return res[(slice(None),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        res = self[:]
+        return res if dtype is None else res.astype(dtype)
+
+
+class AnalysisReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        lengths = self.index[name]
+        return LazySeries([chunk_path(self.path, name, i) for i in range(len(lengths))], lengths)
+
+
+def load_series(path, name):
+    # a series as an array, the analysis dirs written before the store hold a single <series>.npy
+    if os.path.exists(os.path.join(path, 'index.json')):
+        reader = AnalysisReader(path)
+        if name in reader:
+            return np.asarray(reader[name])
+    return np.load(os.path.join(path, name + '.npy'), allow_pickle=True)
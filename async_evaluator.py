@@ -0,0 +1,84 @@
+import json
+import asyncio
+import numpy as np
+
+
+class HttpObjective(object):
+
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.host = host
+        self.port = int(port)
+
+    async def __call__(self, key, x):
+        body = json.dumps({'id': key, 'x': [float(xi) for xi in x]}).encode()
+        header = 'POST / HTTP/1.0\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(self.host, len(body))
+
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(header.encode() + body)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        # a server that dies mid reply leaves a truncated response, retried like a connection error
+        status, _, payload = response.partition(b'\r\n\r\n')
+        try:
+            code = int(status.split(b' ', 2)[1])
+            if code == 200:
+                return float(json.loads(payload)['f'])
+        except (ValueError, IndexError, KeyError, TypeError) as e:
+            raise OSError("objective server: malformed response {!r}".format(response[:200])) from e
+        raise OSError("objective server: {}".format(payload.decode(errors='replace')))
+
+
+class AsyncEvaluator(object):
+
+    def __init__(self, objective, concurrency=16, timeout=None, retries=0, backoff=0.1):
+        self.objective = objective
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.loop = asyncio.new_event_loop()
+
+    async def evaluate(self, semaphore, key, x):
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(self.objective(key, x), self.timeout)
+                except (asyncio.TimeoutError, OSError) as e:
+                    error = e
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+        raise RuntimeError("evaluation failed after {} attempts: {!r}".format(self.retries + 1, error))
+
+    async def gather(self, key, policy):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*[self.evaluate(semaphore, key, x) for x in policy])
+
+    def __call__(self, key, policy):
+        return np.array(self.loop.run_until_complete(self.gather(key, policy)), dtype=np.float64)
+
+    def close(self):
+        self.loop.close()
+
+
+if __name__ == "__main__":
+    import time
+    import threading
+    from bbob import BBOBProblem
+    from objective_server import serve
+
+    server = serve(port=0, delay=0.05)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    evaluator = AsyncEvaluator(HttpObjective('127.0.0.1:{}'.format(server.server_address[1])), concurrency=32, timeout=5, retries=2)
+
+    problem_id = 'bbob_f010_i01_d10'
+    x = np.random.uniform(-5, 5, size=(64, 10))
+    start = time.time()
+    res = evaluator(problem_id, x)
+    assert np.allclose(res, BBOBProblem.from_id(problem_id).batch(x))
+    print("64 evaluations with 50ms latency in {:.2f}s".format(time.time() - start))
+    evaluator.close()
+    server.shutdown()
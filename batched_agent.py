@@ -0,0 +1,231 @@
+import torch
+import itertools
+from tqdm import tqdm
+from config import args
+from trust_region_agent import TrustRegionAgent
+from model_ddpg import StackedDuelNet, StackedDuelNetMember, StackedAdam, StackedAdamMember
+
+
+class StackedMember(TrustRegionAgent):
+
+    # A problem of a BatchedTrustRegionAgent. Its surrogate is a slice of the stacked surrogate, the
+    # value_optimize calls only request a training that the batched agent runs for all the problems at once.
+
+    def __init__(self, exp_name, env, checkpoint):
+        super(StackedMember, self).__init__(exp_name, env, checkpoint)
+        self.value_iter_request = 0
+
+    def share(self, net, optimizer, k):
+        member_net = StackedDuelNetMember(net, k, self.pi_net)
+        member_optimizer = StackedAdamMember(optimizer, k)
+        if self.algorithm_method in ['EGL']:
+            self.derivative_net, self.optimizer_derivative = member_net, member_optimizer
+        elif self.algorithm_method == 'IGL':
+            self.value_net, self.optimizer_value = member_net, member_optimizer
+
+    def surrogate(self):
+        return self.derivative_net if self.algorithm_method in ['EGL'] else self.value_net
+
+    def reset_net(self):
+        if self.algorithm_method in ['EGL']:
+            self.derivative_net.load_state_dict(self.derivative_net_zero)
+            self.optimizer_derivative.reset()
+        if self.algorithm_method in ['IGL']:
+            self.value_net.load_state_dict(self.value_net_zero)
+            self.optimizer_value.reset()
+
+    def value_optimize(self, value_iter):
+        self.value_iter_request = value_iter
+
+
+class BatchedTrustRegionAgent(object):
+
+    # Optimizes several problems of the same dimension in lockstep. Every problem keeps the exploration, trust
+    # region, normalizer, replay buffer and budget of its own TrustRegionAgent, the surrogates of all the
+    # problems are trained together as a single StackedDuelNet.
+
+    def __init__(self, exp_name, envs, checkpoint):
+        if args.spline or args.egl_pairs or args.early_stop_patience > 0 or args.ensemble > 1:
+            raise NotImplementedError("batched problems support a single DuelNet surrogate with the EGL and IGL losses")
+        if args.load_last_model:
+            raise NotImplementedError("batched problems are not resumed from their checkpoints")
+
+        self.members = [StackedMember(exp_name, env, checkpoint) for env in envs]
+        self.device = self.members[0].device
+        self.dtype = self.members[0].dtype
+        self.algorithm_method = args.algorithm
+        self.action_space = args.action_space
+        self.n_explore = args.n_explore
+        self.max_batch = args.batch
+        self.q_loss = self.members[0].q_loss
+
+        self.net = StackedDuelNet([member.surrogate() for member in self.members]).to(self.device)
+        self.optimizer = StackedAdam(self.net.parameters(), lr=args.value_lr, eps=1.5e-4)
+        for k, member in enumerate(self.members):
+            member.share(self.net, self.optimizer, k)
+
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(int(torch.randint(2 ** 62, (1,))))
+
+    def minimize(self):
+        for member in self.members:
+            member.start()
+        self.value_optimize()
+
+        active = list(range(len(self.members)))
+        for i in tqdm(itertools.count()):
+            steps = {}
+            for k in active:
+                step = self.members[k].explore_step()
+                if step is not None:
+                    steps[k] = step
+
+            active = list(steps)
+            if not active:
+                break
+
+            for k in active:
+                if len(self.members[k].replay):
+                    self.members[k].value_optimize(self.members[k].value_iter)
+            self.value_optimize()
+
+            for k in list(active):
+                member = self.members[k]
+                status = member.policy_step(i, *steps[k])
+                if status is None:
+                    continue
+
+                member.save_and_print_results(i, status)
+                yield k, member.results
+                if status == 'finished':
+                    print("FINISHED SUCCESSFULLY - PROBLEM %d FRAME %d" % (member.problem_index, member.frame))
+                    active.remove(k)
+                    continue
+                elif status == 'failed':
+                    print("FAILED problem = {} frame = {}".format(member.problem_index, member.frame))
+                    active.remove(k)
+                    continue
+
+                member.reset_result()
+                if status == 'divergence':
+                    member.warmup()
+
+            # the warmups of the problems that diverged
+            self.value_optimize()
+
+    def value_optimize(self):
+        members = [k for k, member in enumerate(self.members) if member.value_iter_request]
+        if not members:
+            return
+
+        value_iter = [self.members[k].value_iter_request for k in members]
+        for k in members:
+            self.members[k].value_iter_request = 0
+
+        # the replay buffers are padded to the longest one, the rows of every minibatch are masked per problem
+        n = len(members)
+        rewards = [self.members[k].r_norm(self.members[k].replay.rewards()) for k in members]
+        policies = [self.members[k].replay.policies() for k in members]
+        sizes = [len(r) for r in rewards]
+        length = max(sizes)
+        reward = torch.zeros(n, length, dtype=self.dtype, device=self.device)
+        policy = torch.zeros(n, length, self.action_space, dtype=self.dtype, device=self.device)
+        for j, (r, pi) in enumerate(zip(rewards, policies)):
+            reward[j, :len(r)] = r
+            policy[j, :len(pi)] = pi
+
+        batch = [min(self.max_batch, size) for size in sizes]
+        minibatches = [size // b for size, b in zip(sizes, batch)]
+        iterations = max(value_iter)
+        n_batch, n_minibatches = max(batch), max(minibatches)
+
+        batch_range = torch.arange(n_batch, device=self.device).view(1, 1, -1)
+        minibatch_range = torch.arange(n_minibatches, device=self.device).view(1, -1, 1)
+        batch_size = torch.tensor(batch, device=self.device).view(-1, 1, 1)
+        valid = (batch_range < batch_size) & (minibatch_range < torch.tensor(minibatches, device=self.device).view(-1, 1, 1))
+        offset = torch.where(valid, batch_size * minibatch_range + batch_range, torch.zeros_like(batch_range))
+        offset = offset.view(n, -1)
+        # the loss of a problem is the mean over the rows of its minibatch
+        weight = valid.to(self.dtype) / valid.sum(dim=2, keepdim=True).clamp(min=1).to(self.dtype)
+        padding = torch.arange(length, device=self.device).view(1, -1) >= torch.tensor(sizes, device=self.device).view(-1, 1)
+
+        step_mask = torch.zeros(iterations, n_minibatches, len(self.members), dtype=self.dtype)
+        for j, k in enumerate(members):
+            step_mask[:value_iter[j], :minibatches[j], k] = 1
+        step_mask = step_mask.to(self.device)
+        loss_mask = step_mask[:, :, members]
+
+        index = None if n == len(self.members) else torch.tensor(members, device=self.device)
+        problem_range = torch.arange(n, device=self.device).view(-1, 1)
+        eps = [self.members[k].epsilon * self.members[k].pertub for k in members]
+        eps = torch.tensor(eps, dtype=self.dtype, device=self.device).view(-1, 1, 1, 1) if any(eps) else None
+
+        loss = torch.zeros(n, dtype=self.dtype, device=self.device)
+        for t in range(iterations):
+            # a random permutation of the rows of every replay buffer, the padding rows are sorted last
+            scores = torch.rand(n, length, generator=self.generator, device=self.device).masked_fill(padding, 2)
+            anchor_index = scores.argsort(dim=1).gather(1, offset)
+
+            if self.algorithm_method in ['EGL']:
+                # the reference of every anchor is drawn from the exploration group of the anchor
+                ref_index = torch.randint(self.n_explore, anchor_index.shape, generator=self.generator, device=self.device)
+                ref_index += self.n_explore * (anchor_index // self.n_explore)
+
+                r_1 = reward.gather(1, anchor_index).view(n, n_minibatches, n_batch)
+                r_2 = reward.gather(1, ref_index).view(n, n_minibatches, n_batch)
+                pi_1 = policy[problem_range, anchor_index].view(n, n_minibatches, n_batch, -1)
+                pi_2 = policy[problem_range, ref_index].view(n, n_minibatches, n_batch, -1)
+                pi_1_perturb = self.ball_perturb(pi_1, eps)
+
+                for i in range(n_minibatches):
+                    self.optimizer.zero_grad()
+                    loss_q = self.EGL_loss(pi_1_perturb[:, i], pi_1[:, i], pi_2[:, i], r_1[:, i], r_2[:, i], weight[:, i], index)
+                    loss_q.sum().backward()
+                    self.optimizer.step(step_mask[t, i])
+                    loss += loss_q.detach() * loss_mask[t, i]
+
+            elif self.algorithm_method == 'IGL':
+                r = reward.gather(1, anchor_index).view(n, n_minibatches, n_batch)
+                pi = policy[problem_range, anchor_index].view(n, n_minibatches, n_batch, -1)
+
+                for i in range(n_minibatches):
+                    self.optimizer.zero_grad()
+                    loss_q = self.IGL_loss(pi[:, i], r[:, i], weight[:, i], index)
+                    loss_q.sum().backward()
+                    self.optimizer.step(step_mask[t, i])
+                    loss += loss_q.detach() * loss_mask[t, i]
+
+            else:
+                raise NotImplementedError
+
+        for k, iters, l in zip(members, value_iter, loss.tolist()):
+            member = self.members[k]
+            if self.algorithm_method in ['EGL']:
+                member.results['derivative_loss'] = l / iters
+            else:
+                member.results['value_loss'].append(l / iters)
+            member.results['value_iterations'].append(iters)
+
+    def ball_perturb(self, pi, eps):
+
+        if eps is None:
+            return pi
+
+        x = torch.randn(pi.shape, generator=self.generator, dtype=self.dtype, device=self.device)
+        mag = torch.rand(pi.shape[:-1] + (1,), generator=self.generator, dtype=self.dtype, device=self.device)
+
+        x = x / (torch.norm(x, dim=-1, keepdim=True) + 1e-8)
+
+        return pi + eps * mag * x
+
+    def IGL_loss(self, policies, rewards, weight, index):
+        q_value = self.net(policies, index).squeeze(2)
+        return (self.q_loss(q_value, rewards) * weight).sum(dim=1)
+
+    def EGL_loss(self, pi_1_perturb, pi_1, pi_2, r_1, r_2, weight, index):
+        pi_tag_1 = self.net(pi_1_perturb, index)
+
+        value = ((pi_2 - pi_1) * pi_tag_1).sum(dim=2)
+        target = (r_2 - r_1)
+
+        return (self.q_loss(value, target) * weight).sum(dim=1)
@@ -0,0 +1,469 @@
+import re
+import numpy as np
+
+# Vectorized reimplementation of the 24 noiseless bbob functions of the COCO platform.
+# The instance data (xopt, fopt, rotations, Gallagher peaks) is generated with the
+# bbob2009 legacy random number generator, so each BBOBProblem reproduces the cocoex
+# problem with the same id. Every function takes an (N, d) array and returns N values.
+
+
+def bbob_unif(n, seed):
+    seed = abs(int(seed))
+    if seed < 1:
+        seed = 1
+    aktseed = seed
+    rgrand = [0] * 32
+    for i in range(39, -1, -1):
+        tmp = aktseed // 127773
+        aktseed = 16807 * (aktseed - tmp * 127773) - 2836 * tmp
+        if aktseed < 0:
+            aktseed += 2147483647
+        if i < 32:
+            rgrand[i] = aktseed
+    aktrand = rgrand[0]
+    r = np.zeros(n)
+    for i in range(n):
+        tmp = aktseed // 127773
+        aktseed = 16807 * (aktseed - tmp * 127773) - 2836 * tmp
+        if aktseed < 0:
+            aktseed += 2147483647
+        tmp = aktrand // 67108865
+        aktrand = rgrand[tmp]
+        rgrand[tmp] = aktseed
+        r[i] = aktrand / 2.147483647e9
+        if r[i] == 0.:
+            r[i] = 1e-99
+    return r
+
+
+def bbob_gauss(n, seed):
+    u = bbob_unif(2 * n, seed)
+    g = np.sqrt(-2 * np.log(u[:n])) * np.cos(2 * np.pi * u[n:])
+    g[g == 0.] = 1e-99
+    return g
+
+
+def bbob_rotation(seed, dim):
+    b = bbob_gauss(dim * dim, seed).reshape(dim, dim).T.copy()
+    for i in range(dim):
+        for j in range(i):
+            b[:, i] -= np.dot(b[:, i], b[:, j]) * b[:, j]
+        b[:, i] /= np.sqrt(np.dot(b[:, i], b[:, i]))
+    return b
+
+
+def bbob_xopt(seed, dim):
+    xopt = 8 * np.floor(1e4 * bbob_unif(dim, seed)) / 1e4 - 4
+    xopt[xopt == 0.] = -1e-5
+    return xopt
+
+
+def bbob_fopt(function, instance):
+    if function == 4:
+        rseed = 3
+    elif function == 18:
+        rseed = 17
+    else:
+        rseed = function
+    rrseed = rseed + 10000 * instance
+    gval = bbob_gauss(1, rrseed)[0]
+    gval2 = bbob_gauss(1, rrseed + 1)[0]
+    return min(1000., max(-1000., np.floor(100 * 100 * gval / gval2 + 0.5) / 100))
+
+
+def _exponents(dim):
+    return np.arange(dim) / max(dim - 1., 1.)
+
+
+def _conditioning(alpha, dim):
+    return alpha ** (0.5 * _exponents(dim))
+
+
+def _rotated_conditioning(rot1, alpha, rot2):
+    # rot1 @ diag(sqrt(alpha)^(i/(d-1))) @ rot2
+    return (rot1 * _conditioning(alpha, len(rot1))) @ rot2
+
+
+def _affine(x, m, b=0.):
+    return x @ m.T + b
+
+
+def _round(x):
+    return np.floor(x + 0.5)
+
+
+def t_osz(x):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.log(np.abs(x)) / 0.1
+        pos = np.exp(t + 0.49 * (np.sin(t) + np.sin(0.79 * t))) ** 0.1
+        neg = -np.exp(t + 0.49 * (np.sin(0.55 * t) + np.sin(0.31 * t))) ** 0.1
+    return np.where(x > 0, pos, np.where(x < 0, neg, x))
+
+
+def t_asy(x, beta):
+    dim = x.shape[-1]
+    with np.errstate(invalid='ignore'):
+        exponent = 1. + beta * _exponents(dim) * np.sqrt(np.maximum(x, 0.))
+        y = np.power(np.abs(x), exponent)
+    return np.where(x > 0, y, x)
+
+
+def penalty(x):
+    return (np.maximum(np.abs(x) - 5., 0.) ** 2).sum(axis=-1)
+
+
+def sphere(z):
+    return (z ** 2).sum(axis=-1)
+
+
+def ellipsoid(z):
+    return (1e6 ** _exponents(z.shape[-1]) * z ** 2).sum(axis=-1)
+
+
+def rastrigin(z):
+    dim = z.shape[-1]
+    return 10. * (dim - np.cos(2 * np.pi * z).sum(axis=-1)) + (z ** 2).sum(axis=-1)
+
+
+def rosenbrock(z):
+    c1 = z[:, :-1] ** 2 - z[:, 1:]
+    c2 = 1. - z[:, :-1]
+    return 100. * (c1 ** 2).sum(axis=-1) + (c2 ** 2).sum(axis=-1)
+
+
+def discus(z):
+    return 1e6 * z[:, 0] ** 2 + (z[:, 1:] ** 2).sum(axis=-1)
+
+
+def bent_cigar(z):
+    return z[:, 0] ** 2 + 1e6 * (z[:, 1:] ** 2).sum(axis=-1)
+
+
+def sharp_ridge(z):
+    return 100. * np.sqrt((z[:, 1:] ** 2).sum(axis=-1)) + z[:, 0] ** 2
+
+
+def different_powers(z):
+    exponent = 2. + 4. * _exponents(z.shape[-1])
+    return np.sqrt((np.abs(z) ** exponent).sum(axis=-1))
+
+
+def f_sphere(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    return lambda x: sphere(x - xopt)
+
+
+def f_ellipsoid(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    return lambda x: ellipsoid(t_osz(x - xopt))
+
+
+def f_rastrigin(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    scales = _conditioning(10., dim)
+    return lambda x: rastrigin(scales * t_asy(t_osz(x - xopt), 0.2))
+
+
+def f_bueche_rastrigin(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    xopt[::2] = np.abs(xopt[::2])
+    scales = _conditioning(10., dim)
+    even = (np.arange(dim) % 2 == 0)
+
+    def f(x):
+        z = t_osz(x - xopt)
+        z = np.where((z > 0) & even, 10. * scales, scales) * z
+        return rastrigin(z) + 100. * penalty(x)
+    return f
+
+
+def f_linear_slope(dim, instance, rseed):
+    xopt = np.where(bbob_xopt(rseed, dim) < 0, -5., 5.)
+    si = np.sign(xopt) * np.sqrt(100.) ** _exponents(dim)
+
+    def f(x):
+        x = np.where(x * xopt < 25., x, xopt)
+        return (5. * np.abs(si) - si * x).sum(axis=-1)
+    return f
+
+
+def f_attractive_sector(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    m = _rotated_conditioning(bbob_rotation(rseed + 1000000, dim), 10., bbob_rotation(rseed, dim))
+
+    def f(x):
+        z = _affine(x - xopt, m)
+        y = np.where(xopt * z > 0, 100. ** 2 * z ** 2, z ** 2).sum(axis=-1)
+        return t_osz(y) ** 0.9
+    return f
+
+
+def f_step_ellipsoid(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    rot2 = bbob_rotation(rseed, dim)
+    scales = np.sqrt((100. / 10.) ** _exponents(dim))
+
+    def f(x):
+        z = scales * _affine(x - xopt, rot2)
+        x1 = z[:, 0]
+        z = np.where(np.abs(z) > 0.5, _round(z), _round(10. * z) / 10.)
+        y = (100. ** _exponents(dim) * _affine(z, rot1) ** 2).sum(axis=-1)
+        return 0.1 * np.maximum(np.abs(x1) / 1e4, y) + penalty(x)
+    return f
+
+
+def f_rosenbrock(dim, instance, rseed):
+    xopt = 0.75 * bbob_xopt(rseed, dim)
+    factor = max(1., np.sqrt(dim) / 8.)
+    return lambda x: rosenbrock(factor * (x - xopt) + 1.)
+
+
+def f_rosenbrock_rotated(dim, instance, rseed):
+    m = max(1., np.sqrt(dim) / 8.) * bbob_rotation(rseed, dim)
+    return lambda x: rosenbrock(_affine(x, m, 0.5))
+
+
+def f_ellipsoid_rotated(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    return lambda x: ellipsoid(t_osz(_affine(x - xopt, rot1)))
+
+
+def f_discus(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    return lambda x: discus(t_osz(_affine(x - xopt, rot1)))
+
+
+def f_bent_cigar(dim, instance, rseed):
+    xopt = bbob_xopt(rseed + 1000000, dim)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    return lambda x: bent_cigar(_affine(t_asy(_affine(x - xopt, rot1), 0.5), rot1))
+
+
+def f_sharp_ridge(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    m = _rotated_conditioning(bbob_rotation(rseed + 1000000, dim), 10., bbob_rotation(rseed, dim))
+    return lambda x: sharp_ridge(_affine(x - xopt, m))
+
+
+def f_different_powers(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    return lambda x: different_powers(_affine(x - xopt, rot1))
+
+
+def f_rastrigin_rotated(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    m = _rotated_conditioning(rot1, 10., bbob_rotation(rseed, dim))
+    return lambda x: rastrigin(_affine(t_asy(t_osz(_affine(x - xopt, rot1)), 0.2), m))
+
+
+def f_weierstrass(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    m = _rotated_conditioning(rot1, 1. / 100., bbob_rotation(rseed, dim))
+    ak = 0.5 ** np.arange(12)
+    bk = 3. ** np.arange(12)
+    f0 = (ak * np.cos(2 * np.pi * bk * 0.5)).sum()
+
+    def f(x):
+        z = _affine(t_osz(_affine(x - xopt, rot1)), m)
+        y = (ak * np.cos(2 * np.pi * (z[:, :, None] + 0.5) * bk)).sum(axis=(1, 2))
+        return 10. * (y / dim - f0) ** 3 + 10. / dim * penalty(x)
+    return f
+
+
+def f_schaffers(conditioning):
+    def allocate(dim, instance, rseed):
+        xopt = bbob_xopt(rseed, dim)
+        rot1 = bbob_rotation(rseed + 1000000, dim)
+        m = _conditioning(conditioning, dim)[:, None] * bbob_rotation(rseed, dim)
+
+        def f(x):
+            z = _affine(t_asy(_affine(x - xopt, rot1), 0.5), m)
+            s = z[:, :-1] ** 2 + z[:, 1:] ** 2
+            y = (s ** 0.25 * (1. + np.sin(50. * s ** 0.1) ** 2)).sum(axis=-1)
+            return (y / (dim - 1.)) ** 2 + 10. * penalty(x)
+        return f
+    return allocate
+
+
+def f_griewank_rosenbrock(dim, instance, rseed):
+    m = max(1., np.sqrt(dim) / 8.) * bbob_rotation(rseed, dim)
+
+    def f(x):
+        z = _affine(x, m, 0.5)
+        s = 100. * (z[:, :-1] ** 2 - z[:, 1:]) ** 2 + (1. - z[:, :-1]) ** 2
+        return 10. + 10. * (s / 4000. - np.cos(s)).sum(axis=-1) / (dim - 1)
+    return f
+
+
+def f_schwefel(dim, instance, rseed):
+    xopt = np.where(bbob_unif(dim, rseed) < 0.5, -1., 1.) * 0.5 * 4.2096874637
+    scales = _conditioning(10., dim)
+    shift = 2 * np.abs(xopt)
+
+    def f(x):
+        x_hat = 2. * np.sign(xopt) * x
+        z_hat = x_hat.copy()
+        z_hat[:, 1:] += 0.25 * (x_hat[:, :-1] - shift[:-1])
+        z = 100. * (scales * (z_hat - shift) + shift)
+        y = (z * np.sin(np.sqrt(np.abs(z)))).sum(axis=-1)
+        pen = (np.maximum(np.abs(z) - 500., 0.) ** 2).sum(axis=-1)
+        return 0.01 * (pen + 418.9828872724339 - y / dim)
+    return f
+
+
+def f_gallagher(number_of_peaks):
+    def allocate(dim, instance, rseed):
+        rotation = bbob_rotation(rseed, dim)
+        maxcondition = 1000.
+        if number_of_peaks == 101:
+            maxcondition1 = np.sqrt(maxcondition)
+            b, c = 10., 5.
+        else:
+            maxcondition1 = maxcondition
+            b, c = 9.8, 4.9
+
+        rperm = np.argsort(bbob_unif(number_of_peaks - 1, rseed), kind='stable')
+        condition = np.concatenate([[maxcondition1], maxcondition ** (rperm / (number_of_peaks - 2.))])
+        peak_values = np.concatenate([[10.], np.arange(number_of_peaks - 1) / (number_of_peaks - 2.) * (9.1 - 1.1) + 1.1])
+
+        scales = np.zeros((number_of_peaks, dim))
+        for i in range(number_of_peaks):
+            rperm = np.argsort(bbob_unif(dim, rseed + 1000 * i), kind='stable')
+            scales[i] = condition[i] ** (rperm / (dim - 1.) - 0.5)
+
+        peaks = b * bbob_unif(dim * number_of_peaks, rseed).reshape(number_of_peaks, dim) - c
+        x_local = peaks @ rotation.T
+        x_local[0] *= 0.8
+
+        def f(x):
+            z = _affine(x, rotation)
+            d = (scales * (z[:, None, :] - x_local) ** 2).sum(axis=-1)
+            y = 10. - (peak_values * np.exp(-0.5 / dim * d)).max(axis=-1)
+            return t_osz(y) ** 2 + penalty(x)
+        return f
+    return allocate
+
+
+def f_katsuura(dim, instance, rseed):
+    xopt = bbob_xopt(rseed, dim)
+    m = _rotated_conditioning(bbob_rotation(rseed + 1000000, dim), 100., bbob_rotation(rseed, dim))
+    powers = 2. ** np.arange(1, 33)
+
+    def f(x):
+        z = _affine(x - xopt, m)[:, :, None] * powers
+        s = (np.abs(z - _round(z)) / powers).sum(axis=-1)
+        y = np.prod((1. + (np.arange(dim) + 1.) * s) ** (10. / dim ** 1.2), axis=-1)
+        return 10. / dim / dim * (y - 1.) + penalty(x)
+    return f
+
+
+def f_lunacek_bi_rastrigin(dim, instance, rseed):
+    mu0 = 2.5
+    d = 1.
+    s = 1. - 0.5 / (np.sqrt(dim + 20.) - 4.1)
+    mu1 = -np.sqrt((mu0 ** 2 - d) / s)
+    rot1 = bbob_rotation(rseed + 1000000, dim)
+    rot2 = bbob_rotation(rseed, dim)
+    sign = np.where(bbob_gauss(dim, rseed) < 0, -1., 1.)
+    m = _rotated_conditioning(rot1, 100., rot2)
+
+    def f(x):
+        x_hat = 2. * sign * x
+        z = _affine(x_hat - mu0, m)
+        sum1 = ((x_hat - mu0) ** 2).sum(axis=-1)
+        sum2 = ((x_hat - mu1) ** 2).sum(axis=-1)
+        sum3 = np.cos(2 * np.pi * z).sum(axis=-1)
+        return np.minimum(sum1, d * dim + s * sum2) + 10. * (dim - sum3) + 1e4 * penalty(x)
+    return f
+
+
+functions = {1: f_sphere,
+             2: f_ellipsoid,
+             3: f_rastrigin,
+             4: f_bueche_rastrigin,
+             5: f_linear_slope,
+             6: f_attractive_sector,
+             7: f_step_ellipsoid,
+             8: f_rosenbrock,
+             9: f_rosenbrock_rotated,
+             10: f_ellipsoid_rotated,
+             11: f_discus,
+             12: f_bent_cigar,
+             13: f_sharp_ridge,
+             14: f_different_powers,
+             15: f_rastrigin_rotated,
+             16: f_weierstrass,
+             17: f_schaffers(10.),
+             18: f_schaffers(1000.),
+             19: f_griewank_rosenbrock,
+             20: f_schwefel,
+             21: f_gallagher(101),
+             22: f_gallagher(21),
+             23: f_katsuura,
+             24: f_lunacek_bi_rastrigin}
+
+
+class BBOBProblem(object):
+
+    def __init__(self, function, dimension, instance, index=None):
+        self.function = function
+        self.dimension = dimension
+        self.instance = instance
+        self.index = index
+        self.id = 'bbob_f%03d_i%02d_d%02d' % (function, instance, dimension)
+
+        self.lower_bounds = -5 * np.ones(dimension)
+        self.upper_bounds = 5 * np.ones(dimension)
+        self.initial_solution = np.zeros(dimension)
+
+        if function == 4:
+            rseed = 3 + 10000 * instance
+        elif function == 18:
+            rseed = 17 + 10000 * instance
+        else:
+            rseed = function + 10000 * instance
+
+        self.fopt = bbob_fopt(function, instance)
+        self.final_target_fvalue1 = self.fopt + 1e-8
+        self.f = functions[function](dimension, instance, rseed)
+
+        self.evaluations = 0
+        self.best_observed_fvalue1 = np.inf
+        self.final_target_hit = False
+
+    @staticmethod
+    def from_id(problem_id, index=None):
+        function, instance, dimension = re.match(r'bbob_f(\d+)_i(\d+)_d(\d+)', problem_id).groups()
+        return BBOBProblem(int(function), int(dimension), int(instance), index=index)
+
+    def batch(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1, self.dimension)
+        res = self.f(x) + self.fopt
+
+        self.evaluations += len(res)
+        self.best_observed_fvalue1 = min(self.best_observed_fvalue1, res.min())
+        self.final_target_hit = self.best_observed_fvalue1 <= self.final_target_fvalue1
+        return res
+
+    def __call__(self, x):
+        if len(np.shape(x)) == 2:
+            return self.batch(x)
+        return self.batch(x)[0]
+
+
+if __name__ == "__main__":
+    import cocoex
+    for dim in [2, 3, 5, 10, 20, 40]:
+        suite = cocoex.Suite("bbob", "", "dimensions: " + str(dim))
+        for problem in suite:
+            x = np.random.uniform(-6, 6, size=(100, dim))
+            expected = np.array([problem(xi) for xi in x])
+            res = BBOBProblem.from_id(problem.id).batch(x)
+            assert np.allclose(res, expected, rtol=1e-8, atol=1e-8), "{} max error {}".format(problem.id, np.abs(res - expected).max())
+        print("dimension {} OK".format(dim))
@@ -0,0 +1,115 @@
+import os
+import re
+import atexit
+import threading
+from collections import OrderedDict
+import torch
+
+# Checkpoints are written by a worker thread. save() copies the state tensors to host memory and returns, the
+# worker writes <name>.<n>.pt through a temporary file and a rename and keeps the last `keep` files of every name.
+# A snapshot that is still waiting when a newer snapshot of the same name arrives is replaced.
+
+
+def snapshot(state):
+    if torch.is_tensor(state):
+        # a private copy, the training steps update the parameters and the optimizer state in place
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        res = state.copy()
+        for k, v in state.items():
+            res[k] = snapshot(v)
+        return res
+    if isinstance(state, list):
+        return [snapshot(v) for v in state]
+    if isinstance(state, tuple):
+        return tuple(snapshot(v) for v in state)
+    return state
+
+
+class CheckpointWriter(object):
+
+    writers = {}
+
+    @classmethod
+    def shared(cls, directory, keep=2):
+        # a single worker per directory for all the agents of the process
+        if directory not in cls.writers:
+            cls.writers[directory] = cls(directory, keep)
+        return cls.writers[directory]
+
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = max(keep, 1)
+        self.pending = OrderedDict()
+        self.busy = False
+        self.error = None
+        self.lock = threading.Condition()
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def checkpoints(self, name):
+        pattern = re.compile(re.escape(name) + r'\.(\d+)\.pt$')
+        files = [(int(m.group(1)), f) for f in os.listdir(self.directory) for m in [pattern.match(f)] if m]
+        return [os.path.join(self.directory, f) for _, f in sorted(files)]
+
+    def latest(self, name):
+        self.flush()
+        checkpoints = self.checkpoints(name)
+        return checkpoints[-1] if checkpoints else None
+
+    def remove(self, name):
+        self.flush()
+        for path in self.checkpoints(name):
+            os.remove(path)
+
+    def save(self, name, state):
+        state = snapshot(state)
+        with self.lock:
+            self.raise_error()
+            self.pending.pop(name, None)
+            self.pending[name] = state
+            self.lock.notify_all()
+
+    def flush(self):
+        with self.lock:
+            while self.pending or self.busy:
+                self.lock.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("checkpoint writer failed") from error
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                name, state = self.pending.popitem(last=False)
+                self.busy = True
+
+            try:
+                self.write(name, state)
+            except Exception as e:
+                self.error = e
+
+            with self.lock:
+                self.busy = False
+                self.lock.notify_all()
+
+    def write(self, name, state):
+        checkpoints = self.checkpoints(name)
+        n = int(checkpoints[-1].rsplit('.', 2)[-2]) + 1 if checkpoints else 0
+        path = os.path.join(self.directory, '{}.{:06d}.pt'.format(name, n))
+
+        tmp = path + '.tmp'
+        torch.save(state, tmp)
+        os.replace(tmp, path)
+
+        for old in (checkpoints + [path])[:-self.keep]:
+            os.remove(old)
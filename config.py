@@ -39,7 +39,9 @@ parser.add_argument('--identifier', type=str, default='debug', help='The name of
 parser.add_argument('--algorithm', type=str, default='EGL', help='[EGL | value | second_order]')
 
 boolean_feature('debug', False, 'debug flag')
+boolean_feature('debug-env', False, 'validate policies and bounds in the environment')
 boolean_feature('spline', False, 'spline net')
+parser.add_argument('--ensemble', type=int, default=1, help='Independently initialized surrogates trained together, pi follows their mean prediction')
 boolean_feature('trust-region', True, 'use trust region')
 
 #boolean_feature('vae', False, 'run vae problem')
@@ -60,7 +62,8 @@ parser.add_argument('--resume', type=int, default=-1, help='Resume experiment nu
 # #exploration parameters
 parser.add_argument('--epsilon', type=float, default=0.1, help='exploration parameter before behavioral period')
 parser.add_argument('--cone-angle', type=float, default=2, help='cone angle - default pi/3')
-parser.add_argument('--explore', type=str, default='ball', help='exploration option - ball | cone | rand')
+parser.add_argument('--explore', type=str, default='ball', help='exploration option - [sobol | halton][-pool][-antithetic]-(ball | cone | rand)')
+parser.add_argument('--sample-pool', type=int, default=1024, help='Number of samples of the pool of a pool exploration sampler')
 boolean_feature("best-explore-update", True, 'move to the best value of exploration')
 parser.add_argument('--trust-region-con', type=int, default=10, help='Trust Region Condition')
 parser.add_argument('--min-iter', type=int, default=40, help='Minimum iteration')
@@ -70,20 +73,40 @@ parser.add_argument('--agent', type=str, default='trust', help='Agent type - tru
 # #dataloader
 parser.add_argument('--cpu-workers', type=int, default=24, help='How many CPUs will be used for the data loading')
 parser.add_argument('--cuda-default', type=int, default=0, help='Default GPU')
+parser.add_argument('--bbob-engine', type=str, default='coco', help='bbob objective implementation - coco | numpy')
+parser.add_argument('--eval-cache', type=int, default=0, help='Size of the LRU evaluation cache (0 - disabled)')
+boolean_feature('compile', False, 'Compile the surrogate training step with torch.compile')
+boolean_feature('cache-budget', True, 'cache hits count against the evaluation budget')
+parser.add_argument('--eval-workers', type=int, default=0, help='Worker processes for evaluating exploration batches (0 - serial)')
+parser.add_argument('--trace-dir', type=str, default='', help='Record every evaluation to <trace-dir>/<problem id>.trace (empty - disabled)')
+parser.add_argument('--replay-trace', type=str, default='', help='Answer evaluations from the traces in this directory instead of the objective (empty - disabled)')
+parser.add_argument('--replay-mode', type=str, default='nearest', help='trace replay - nearest | sequence')
+parser.add_argument('--async-objective', type=str, default='', help='host:port of an HTTP objective server, batches are evaluated concurrently (empty - disabled)')
+parser.add_argument('--async-concurrency', type=int, default=16, help='Maximal number of concurrent requests to the objective server')
+parser.add_argument('--async-timeout', type=float, default=60, help='Seconds before a request to the objective server is retried')
+parser.add_argument('--async-retries', type=int, default=2, help='Retries of a failed request to the objective server')
 #
 # #train parameters
 parser.add_argument('--printing-interval', type=int, default=50, help='Number of exploration steps between printing results')
+parser.add_argument('--checkpoint-keep', type=int, default=2, help='Number of checkpoints kept per problem')
 parser.add_argument('--replay-memory-factor', type=int, default=32, help='Replay factor')
 parser.add_argument('--warmup-minibatch', type=int, default=5, help='Warm up batches')
 parser.add_argument('--trust-factor', type=float, default=0.9, help='Warm up factor')
 parser.add_argument('--r-norm-alg', type=str, default='log', help='log |relu | tanh | none')
+boolean_feature('r-norm-sketch', False, 'Estimate the reward normalizer quantiles with a streaming P2 sketch instead of per batch')
 parser.add_argument('--epsilon-factor', type=float, default=0.97, help='Epsilon factor')
 parser.add_argument('--learn-iteration', type=int, default=60, help='Learning iteration')
+parser.add_argument('--early-stop-patience', type=int, default=0, help='Learning iterations without improvement of the held-out loss before stopping (0 - always run learn-iteration)')
+parser.add_argument('--early-stop-min', type=int, default=5, help='Minimal number of learning iterations with early stopping')
+parser.add_argument('--early-stop-delta', type=float, default=1e-3, help='Relative decrease of the held-out loss counted as an improvement')
+parser.add_argument('--early-stop-holdout', type=float, default=0.1, help='Fraction of the replay exploration groups held out for early stopping')
 parser.add_argument('--alpha', type=float, default=0.5, help='moving avg factor')
 parser.add_argument('--loss', type=str, default='huber', help='derivative loss huber|mse')
+parser.add_argument('--egl-pairs', type=int, default=0, help='EGL references per anchor within its exploration group - 0: one random reference | -1: all pairs | k: k random pairs')
 parser.add_argument('--start', type=int, default=0, help='')
 parser.add_argument('--stop', type=int, default=360, help='')
 parser.add_argument('--filter', type=int, default=15, help='')
+parser.add_argument('--batch-problems', type=int, default=1, help='Number of consecutive problems optimized together by a single batched agent (with --filter 1 they are instances of the same function)')
 
 
 #
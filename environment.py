@@ -1,26 +1,232 @@
 import numpy as np
 import torch
+import math
+from collections import OrderedDict
 from config import args
+from evaluation_trace import TraceReplay
+from bbob import bbob_fopt
+
+class ArrayHistory(object):
+
+    def __init__(self, dtype=np.float64, chunk=4096):
+        self.dtype = dtype
+        self.chunk = chunk
+        self.data = None
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def reserve(self, n, shape):
+        if self.data is None:
+            self.data = np.empty((max(n, self.chunk),) + shape, dtype=self.dtype)
+        elif n > len(self.data):
+            data = np.empty((max(n, 2 * len(self.data)),) + self.data.shape[1:], dtype=self.dtype)
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+
+    def append(self, x):
+        x = np.asarray(x, dtype=self.dtype)
+        self.reserve(self.n + 1, x.shape)
+        self.data[self.n] = x
+        self.n += 1
+
+    def extend(self, x):
+        x = np.asarray(x, dtype=self.dtype)
+        self.reserve(self.n + len(x), x.shape[1:])
+        self.data[self.n:self.n + len(x)] = x
+        self.n += len(x)
+
+    def state_dict(self):
+        return {'data': self.view().copy()}
+
+    def load_state_dict(self, state):
+        self.data, self.n = None, 0
+        if len(state['data']):
+            self.extend(state['data'])
+
+    def view(self, start=0):
+        if self.data is None:
+            return np.array([], dtype=self.dtype)
+        return self.data[start:self.n]
+
+
+class BudgetExhausted(RuntimeError):
+    pass
+
+
+class EvaluationCache(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, x):
+        key = np.ascontiguousarray(x, dtype=np.float64).tobytes()
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        return None
+
+    def put(self, x, value):
+        key = np.ascontiguousarray(x, dtype=np.float64).tobytes()
+        self.cache[key] = value
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def state_dict(self):
+        return {'cache': OrderedDict(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+    def load_state_dict(self, state):
+        self.cache = OrderedDict(state['cache'])
+        self.hits, self.misses = state['hits'], state['misses']
+
 
 class Env(object):
 
     def __init__(self, problem_iter, need_norm=True, to_numpy=True):
         self.need_norm = need_norm
         self.problem_iter = problem_iter
-        self.observed_list = []
-        self.best_list = []
-        self.pi_list = []
+        self.observed_list = ArrayHistory()
+        self.best_list = ArrayHistory()
+        self.pi_list = ArrayHistory()
         self.to_numpy = to_numpy
         self.budget = 1.1*args.budget
         self.samples = 0
+        self.evaluations = 0
+        self.best_observed_fvalue1 = np.inf
+        self.final_target_fvalue1 = -np.inf
+        self.final_target_hit = False
+        self.cache = EvaluationCache(args.eval_cache) if args.eval_cache > 0 else None
+        self.trace = None
+        self.device = torch.device('cpu')
+        self.dtype = torch.float
 
         if self.need_norm:
             self.denormalize = self.with_denormalize
         else:
             self.denormalize = self.no_normalization
 
+    def set_bounds(self, lower_bounds, upper_bounds):
+        self.lower_bounds = lower_bounds
+        self.upper_bounds = upper_bounds
+        self.scale = 0.5 * (upper_bounds - lower_bounds)
+        self.offset = 0.5 * (upper_bounds + lower_bounds)
+
+    def with_denormalize(self, policy):
+        if args.debug_env:
+            assert (policy.max() <= 1) and (policy.min() >= -1), "denormalized {}".format(policy)
+        policy *= self.scale
+        policy += self.offset
+        return policy
+
+    def no_normalization(self, policy):
+        np.clip(policy, self.lower_bounds, self.upper_bounds, out=policy)
+        return policy
+
+    def transform(self, policy):
+        raise NotImplementedError
+
+    def evaluate_batch(self, policy):
+        raise NotImplementedError
+
+    def cache_keys(self, policy):
+        return policy
+
+    def remaining_budget(self):
+        return max(int(math.ceil(self.budget)) - self.samples, 0)
+
+    def check_budget(self, n):
+        if n > self.remaining_budget():
+            raise BudgetExhausted("{} evaluations requested, {} left".format(n, self.remaining_budget()))
+
+    def state_dict(self):
+        state = {'samples': self.samples, 'evaluations': self.evaluations,
+                 'best_observed_fvalue1': self.best_observed_fvalue1, 'final_target_hit': self.final_target_hit,
+                 'best_observed': self.best_observed, 'reward': self.reward, 'k': self.k, 't': self.t,
+                 'observed_list': self.observed_list.state_dict(), 'best_list': self.best_list.state_dict(),
+                 'pi_list': self.pi_list.state_dict()}
+        if self.cache is not None:
+            state['cache'] = self.cache.state_dict()
+        if self.trace is not None:
+            state['trace'] = self.trace.tell()
+        return state
+
+    def load_state_dict(self, state):
+        self.samples, self.evaluations = state['samples'], state['evaluations']
+        self.best_observed_fvalue1, self.final_target_hit = state['best_observed_fvalue1'], state['final_target_hit']
+        self.best_observed, self.reward, self.k, self.t = state['best_observed'], state['reward'], state['k'], state['t']
+        self.observed_list.load_state_dict(state['observed_list'])
+        self.best_list.load_state_dict(state['best_list'])
+        self.pi_list.load_state_dict(state['pi_list'])
+        if self.cache is not None and 'cache' in state:
+            self.cache.load_state_dict(state['cache'])
+        if self.trace is not None and 'trace' in state:
+            # drop the records evaluated after the checkpoint
+            self.trace.truncate(state['trace'])
+
     def get_observed_and_pi_list(self):
-        return self.best_list, self.observed_list, self.pi_list
+        return self.best_list.view(), self.observed_list.view(), self.pi_list.view()
+
+    def observe(self, res):
+        res = np.atleast_1d(np.asarray(res, dtype=np.float64))
+        if not len(res):
+            return res
+        best = np.minimum.accumulate(np.concatenate([[self.best_observed_fvalue1], res]))[1:]
+        self.observed_list.extend(res)
+        self.best_list.extend(best)
+
+        self.samples += len(res)
+        self.evaluations += len(res)
+        self.best_observed_fvalue1 = best[-1]
+        self.final_target_hit = self.best_observed_fvalue1 <= self.final_target_fvalue1
+        return res
+
+    def evaluate(self, policy, evaluate_batch, keys=None):
+        res = self.evaluate_with_cache(policy, evaluate_batch, keys)
+        if self.trace is not None:
+            self.trace.append(policy if keys is None else keys, res)
+        return res
+
+    def evaluate_with_cache(self, policy, evaluate_batch, keys=None):
+        if self.cache is None:
+            return self.observe(evaluate_batch(policy))
+
+        keys = policy if keys is None else keys
+        res = np.zeros(len(keys))
+        miss = []
+        for i in range(len(keys)):
+            value = self.cache.get(keys[i])
+            if value is None:
+                miss.append(i)
+            else:
+                res[i] = value
+
+        miss = np.array(miss, dtype=np.int64)
+        if len(miss):
+            res[miss] = evaluate_batch(policy[miss])
+            for i in miss:
+                self.cache.put(keys[i], res[i])
+
+        if args.cache_budget:
+            self.observe(res)
+            self.evaluations -= len(res) - len(miss)
+        else:
+            self.observe(res[miss])
+        return res
+
+    def cached_f0(self, x, evaluate_batch):
+        if self.cache is None:
+            return evaluate_batch(x.reshape(1, -1))[0]
+        value = self.cache.get(x)
+        if value is None:
+            value = evaluate_batch(x.reshape(1, -1))[0]
+            self.cache.put(x, value)
+        return value
 
     def get_problem_dim(self):
         raise NotImplementedError
@@ -38,10 +244,23 @@ class Env(object):
         raise NotImplementedError
 
     def reset(self):
-        raise NotImplementedError
+        self.best_observed = None
+        self.reward = None
+        self.k = 0
+        self.t = 0
 
     def step_policy(self, policy):
-        raise NotImplementedError
+        self.check_budget(len(policy))
+        policy = self.transform(policy)
+        if args.debug_env:
+            assert ((policy >= self.lower_bounds) & (policy <= self.upper_bounds)).all(), "clipping error {}".format(policy)
+
+        batch_res = self.evaluate(policy, self.evaluate_batch, keys=self.cache_keys(policy))
+        self.k += len(batch_res)
+
+        self.reward = torch.as_tensor(batch_res, dtype=self.dtype, device=self.device)
+        self.best_observed = self.best_observed_fvalue1
+        self.t = self.final_target_hit
 
     def f(self, policy):
         raise NotImplementedError
@@ -49,13 +268,17 @@ class Env(object):
     def get_f0(self):
         raise NotImplementedError
 
-    def denormalize(self):
-        raise NotImplementedError
+def final_target_fvalue1(problem):
+    # the cocoex problems do not expose the target, it is fopt + 1e-8 of the bbob (function, instance)
+    if hasattr(problem, 'final_target_fvalue1'):
+        return problem.final_target_fvalue1
+    return bbob_fopt(problem.id_function, problem.id_instance) + 1e-8
 
 class EnvCoco(Env):
 
-    def __init__(self, problem, problem_index, need_norm, to_numpy):
+    def __init__(self, problem, problem_index, need_norm, to_numpy, evaluator=None):
         super(EnvCoco, self).__init__(problem_index, need_norm, to_numpy)
+        self.evaluator = evaluator
         self.best_observed = None
         self.reward = None
         self.t = 0
@@ -64,12 +287,20 @@ class EnvCoco(Env):
         self.output_size = self.problem.dimension
 
         self.reset()
-        self.upper_bounds = self.problem.upper_bounds
-        self.lower_bounds = self.problem.lower_bounds
+        self.set_bounds(self.problem.lower_bounds, self.problem.upper_bounds)
         self.initial_solution = self.problem.initial_solution
+        self.final_target_fvalue1 = final_target_fvalue1(self.problem)
+        self.evaluator_key = ('bbob', 'dimensions: ' + str(self.problem.dimension), problem_index)
 
     def get_f0(self):
-        return self.problem(self.initial_solution)
+        return self.cached_f0(self.initial_solution, self.evaluate_batch)
+
+    def evaluate_batch(self, policy):
+        if self.evaluator is not None and len(policy) > 1:
+            return self.evaluator(self.evaluator_key, policy)
+        elif hasattr(self.problem, 'batch'):
+            return self.problem.batch(policy)
+        return [self.problem(policy[i]) for i in range(policy.shape[0])]
 
     def get_problem_dim(self):
         return self.problem.dimension
@@ -80,68 +311,17 @@ class EnvCoco(Env):
     def get_initial_solution(self):
         return self.initial_solution
 
-    def reset(self):
-        self.best_observed = None
-        self.reward = None
-        self.k = 0
-        self.t = 0
-
-    def no_normalization(self, policy):
-        policy = np.clip(policy, a_min=self.lower_bounds, a_max=self.upper_bounds)
-        return policy
-
-    def with_denormalize(self, policy):
-        assert (np.max(policy) <= 1) or (np.min(policy) >= -1), "denormalized {}".format(policy)
-        if len(policy.shape) == 2:
-            assert (policy.shape[1] == self.output_size), "action error"
-            upper = np.repeat(self.upper_bounds.reshape(1, -1), policy.shape[0], axis=0)
-            lower = np.repeat(self.lower_bounds.reshape(1, -1), policy.shape[0], axis=0)
-        else:
-            upper = self.upper_bounds
-            lower = self.lower_bounds
-
-        policy = 0.5 * (policy + 1) * (upper - lower) + lower
-        return policy
-
-    def step_policy(self, policy):
+    def transform(self, policy):
         if self.to_numpy:
             policy = policy.cpu().numpy()
-        policy = self.denormalize(policy)
-        assert ((np.clip(policy, self.lower_bounds, self.upper_bounds) - policy).sum() < 0.000001), "clipping error {}".format(policy)
-        self.reward = []
-        if len(policy.shape) == 2:
-            for i in range(policy.shape[0]):
-                res = self.problem(policy[i])
-                self.observed_list.append(res)
-                self.best_list.append(self.problem.best_observed_fvalue1)
-                self.samples += 1
-                self.reward.append(res)
-                self.k += 1
-        else:
-            res = self.problem(policy)
-            self.observed_list.append(res)
-            self.best_list.append(self.problem.best_observed_fvalue1)
-            self.samples += 1
-            self.reward.append(res)
-            self.k += 1
-
-        if self.samples >= self.budget:
-            raise RuntimeError
-        self.reward = torch.cuda.FloatTensor(self.reward)
-        self.best_observed = self.problem.best_observed_fvalue1
-        self.t = self.problem.final_target_hit
+        policy = np.array(policy, dtype=np.float64).reshape(-1, self.output_size)
+        return self.denormalize(policy)
 
     def f(self, policy):
-        if self.to_numpy:
-            policy = policy.cpu().numpy()
-        policy = self.denormalize(policy)
-        res = self.problem(policy)
-        self.observed_list.append(res)
-        self.best_list.append(self.problem.best_observed_fvalue1)
-        self.pi_list.append(policy)
-        self.samples += 1
-        if self.samples >= self.budget:
-            raise RuntimeError
+        self.check_budget(1)
+        policy = self.transform(policy)
+        res = self.evaluate(policy, self.evaluate_batch)[0]
+        self.pi_list.append(policy[0])
         return res
 
     def get_problem_index(self):
@@ -150,6 +330,30 @@ class EnvCoco(Env):
     def get_problem_id(self):
         return 'coco_' + str(self.problem.id)
 
+class EnvReplay(EnvCoco):
+
+    def __init__(self, problem, problem_index, need_norm, to_numpy, path, mode='nearest'):
+        super(EnvReplay, self).__init__(problem, problem_index, need_norm, to_numpy)
+        self.replay = TraceReplay(path, self.output_size)
+        self.mode = mode
+
+    def get_f0(self):
+        return self.replay.nearest(self.initial_solution)[0]
+
+    def evaluate_batch(self, policy):
+        if self.mode == 'sequence':
+            return self.replay.sequence(len(policy))
+        return self.replay.nearest(policy)
+
+class EnvAsync(EnvCoco):
+
+    def __init__(self, problem, problem_index, need_norm, to_numpy, evaluator):
+        super(EnvAsync, self).__init__(problem, problem_index, need_norm, to_numpy, evaluator=evaluator)
+        self.evaluator_key = self.problem.id
+
+    def evaluate_batch(self, policy):
+        return self.evaluator(self.evaluator_key, policy)
+
 class EnvVae(Env):
 
     def __init__(self, vae_problem, problem_index, to_numpy):
@@ -162,9 +366,9 @@ class EnvVae(Env):
         self.output_size = self.problem.dimension
 
         self.reset()
-        self.upper_bounds = self.problem.upper_bounds.detach().to(self.problem.device)
-        self.lower_bounds = self.problem.lower_bounds.detach().to(self.problem.device)
+        self.set_bounds(self.problem.lower_bounds.detach().to(self.problem.device), self.problem.upper_bounds.detach().to(self.problem.device))
         self.initial_solution = self.problem.initial_solution.detach().cpu().numpy()
+        self.final_target_fvalue1 = final_target_fvalue1(self.problem.problem)
 
     def get_problem_dim(self):
         return self.output_size
@@ -181,81 +385,37 @@ class EnvVae(Env):
     def get_initial_solution(self):
         return self.initial_solution
 
-    def reset(self):
-        self.best_observed = None
-        self.reward = None
-        self.k = 0
-        self.t = 0
-
     def no_normalization(self, policy):
+        return torch.min(torch.max(policy, self.lower_bounds), self.upper_bounds)
 
-        policy = torch.min(torch.max(policy, self.lower_bounds), self.upper_bounds)
-        return policy
-
-    def with_denormalize(self, policy):
-        assert (torch.max(policy) <= 1) or (torch.min(policy) >= -1), "denormalized"
-        if len(policy.shape) == 2:
-            assert (policy.shape[1] == self.output_size), "action error, shape is {} and not {}".format(policy.shape[1], self.output_size)
-            upper = torch.repeat(self.upper_bounds.reshape(1, -1), policy.shape[0], axis=0)
-            lower = torch.repeat(self.lower_bounds.reshape(1, -1), policy.shape[0], axis=0)
-        else:
-            upper = self.upper_bounds
-            lower = self.lower_bounds
-
-        policy = 0.5 * (policy + 1) * (upper - lower) + lower
-        return policy
-
-    def step_policy(self, policy):
+    def transform(self, policy):
         if self.to_numpy == False:
-            policy = torch.cuda.FloatTensor(policy)
-
-        policy = self.denormalize(policy)
-        assert ((policy <= self.upper_bounds).all() and (policy >= self.lower_bounds).all()), "clipping error {}".format(policy)
-
-        self.reward = []
-        if len(policy.shape) == 2:
-            for i in range(policy.shape[0]):
-                res = self.problem.func(policy[i])
-                self.observed_list.append(res)
-                self.best_list.append(self.problem.problem.best_observed_fvalue1)
-                self.samples += 1
-                self.reward.append(res)
-                self.k += 1
-        else:
-            res = self.problem.func(policy)
-            self.observed_list.append(res)
-            self.best_list.append(self.problem.problem.best_observed_fvalue1)
-            self.samples += 1
-            self.reward.append(res)
-            self.k += 1
+            policy = torch.as_tensor(policy, dtype=torch.float, device=self.problem.device)
+        return self.denormalize(policy.view(-1, self.output_size))
 
-        if self.samples >= self.budget:
-            raise RuntimeError
+    def cache_keys(self, policy):
+        return policy.detach().cpu().numpy()
 
-        self.reward = torch.cuda.FloatTensor(self.reward)
-        self.best_observed = self.problem.problem.best_observed_fvalue1
-        self.t = self.problem.problem.final_target_hit
+    def evaluate_batch(self, policy):
+        return self.problem.func_batch(policy)
 
     def f(self, policy):
         if self.to_numpy == False:
-            policy = torch.cuda.FloatTensor(policy)
+            policy = torch.as_tensor(policy, dtype=torch.float, device=self.problem.device)
 
-        res = self.problem.func(policy)
-        self.observed_list.append(res)
-        self.best_list.append(self.problem.problem.best_observed_fvalue1)
-        self.pi_list.append(policy)
-        self.samples += 1
-        if self.samples >= self.budget:
-            raise RuntimeError
+        self.check_budget(1)
+        res = self.evaluate(policy.view(1, -1), self.evaluate_batch, keys=policy.detach().cpu().numpy().reshape(1, -1))[0]
+        self.pi_list.append(policy.detach().cpu().numpy())
         return res
 
     def get_f0(self):
-        return self.problem.func(self.initial_solution)
+        return self.cached_f0(self.initial_solution, lambda x: self.problem.func_batch(torch.FloatTensor(x)))
 
 class EnvOneD(Env):
 
-    def __init__(self, problem, problem_index, need_norm, to_numpy):
+    def __init__(self, problem, problem_index, need_norm, to_numpy, evaluator=None):
         super(EnvOneD, self).__init__(problem_index, need_norm, to_numpy)
+        self.evaluator = evaluator
         self.best_observed = None
         self.reward = None
         self.t = 0
@@ -264,12 +424,20 @@ class EnvOneD(Env):
         self.output_size = self.problem.dimension
 
         self.reset()
-        self.upper_bounds = self.problem.upper_bounds[0]
-        self.lower_bounds = self.problem.lower_bounds[0]
+        self.set_bounds(self.problem.lower_bounds[0], self.problem.upper_bounds[0])
         self.initial_solution = np.array([self.problem.initial_solution[0]])
+        self.final_target_fvalue1 = final_target_fvalue1(self.problem)
+        self.evaluator_key = ('bbob', 'dimensions: ' + str(self.problem.dimension), problem_index)
 
     def get_f0(self):
-        return self.problem(one_d_change_dim(self.initial_solution).flatten())
+        return self.cached_f0(one_d_change_dim(self.initial_solution).flatten(), self.evaluate_batch)
+
+    def evaluate_batch(self, policy):
+        if self.evaluator is not None and len(policy) > 1:
+            return self.evaluator(self.evaluator_key, policy)
+        elif hasattr(self.problem, 'batch'):
+            return self.problem.batch(policy)
+        return [self.problem(policy[i]) for i in range(policy.shape[0])]
 
     def get_problem_dim(self):
         return self.output_size
@@ -286,69 +454,22 @@ class EnvOneD(Env):
     def get_initial_solution(self):
         return self.initial_solution
 
-    def reset(self):
-        self.best_observed = None
-        self.reward = None
-        self.k = 0
-        self.t = 0
-
-    def no_normalization(self, policy):
-        policy = np.clip(policy, a_min=self.lower_bounds, a_max=self.upper_bounds)
-        return policy
-
-    def with_denormalize(self, policy):
-        assert (np.max(policy) <= 1) or (np.min(policy) >= -1), "denormalized"
-        if len(policy.shape) == 2:
-            assert (policy.shape[1] == self.output_size), "action error, shape is {} and not {}".format(policy.shape[1], self.output_size)
-            upper = np.repeat(self.upper_bounds.reshape(1, -1), policy.shape[0], axis=0)
-            lower = np.repeat(self.lower_bounds.reshape(1, -1), policy.shape[0], axis=0)
-        else:
-            upper = self.upper_bounds
-            lower = self.lower_bounds
-
-        policy = 0.5 * (policy + 1) * (upper - lower) + lower
-        return policy
-
-    def step_policy(self, policy):
+    def transform(self, policy):
         if self.to_numpy:
             policy = policy.cpu().numpy()
-        policy = self.denormalize(one_d_change_dim(policy))
-        assert ((np.clip(policy, self.lower_bounds, self.upper_bounds) - policy).sum() < 0.000001), "clipping error {}".format(policy)
-        self.reward = []
-        if len(policy.shape) == 2:
-            for i in range(policy.shape[0]):
-                res = self.problem(policy[i])
-                self.observed_list.append(res)
-                self.best_list.append(self.problem.best_observed_fvalue1)
-                self.samples += 1
-                self.reward.append(res)
-                self.k += 1
-        else:
-            res = self.problem(policy)
-            self.observed_list.append(res)
-            self.best_list.append(self.problem.best_observed_fvalue1)
-            self.samples += 1
-            self.reward.append(res)
-            self.k += 1
-
-        if self.samples >= self.budget:
-            raise RuntimeError
+        return self.change_dim(policy)
 
-        self.reward = torch.cuda.FloatTensor(self.reward)
-        self.best_observed = self.problem.best_observed_fvalue1
-        self.t = self.problem.final_target_hit
+    def change_dim(self, policy):
+        # one_d_change_dim with an identity second coordinate, the bounds are equal on both axes
+        policy = np.clip(np.array(policy, dtype=np.float64).reshape(-1, 1), -1, 1)
+        return np.repeat(self.denormalize(policy), self.output_size, axis=1)
 
     def f(self, policy):
         if self.to_numpy:
             policy = policy.cpu().numpy()
+        self.check_budget(1)
         self.pi_list.append(policy)
-        policy = self.denormalize(one_d_change_dim(policy)).flatten()
-        res = self.problem(policy)
-        self.observed_list.append(res)
-        self.best_list.append(self.problem.best_observed_fvalue1)
-        self.samples += 1
-        if self.samples >= self.budget:
-            raise RuntimeError
+        res = self.evaluate(self.change_dim(policy), self.evaluate_batch)[0]
         return res
 
 def one_d_change_dim(policy):
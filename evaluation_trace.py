@@ -0,0 +1,85 @@
+import os
+import numpy as np
+
+# a trace holds the (x, f(x)) records of a single problem as raw float64 rows of dimension + 1 values
+
+
+def trace_path(trace_dir, problem_id):
+    return os.path.join(trace_dir, problem_id + '.trace')
+
+
+class TraceWriter(object):
+
+    def __init__(self, path, dimension, append=False):
+        self.path = path
+        self.dimension = dimension
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # a new run replaces the recording of the problem, a resumed one continues it
+        self.file = open(path, 'ab' if append else 'wb')
+
+    def append(self, x, fx):
+        fx = np.atleast_1d(np.asarray(fx, dtype=np.float64))
+        rows = np.empty((len(fx), self.dimension + 1), dtype=np.float64)
+        rows[:, :-1] = np.asarray(x, dtype=np.float64).reshape(len(fx), self.dimension)
+        rows[:, -1] = fx
+        rows.tofile(self.file)
+        self.file.flush()
+
+    def tell(self):
+        return self.file.tell()
+
+    def truncate(self, size):
+        self.file.truncate(size)
+        self.file.seek(size)
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path, dimension):
+    if not os.path.getsize(path):
+        return np.zeros((0, dimension)), np.zeros(0)
+    rows = np.memmap(path, dtype=np.float64, mode='r').reshape(-1, dimension + 1)
+    return rows[:, :-1], rows[:, -1]
+
+
+class TraceReplay(object):
+
+    def __init__(self, path, dimension, chunk=65536):
+        self.x, self.fx = read_trace(path, dimension)
+        self.chunk = chunk
+        self.k = 0
+        self.sq_norm = None
+
+    def __len__(self):
+        return len(self.fx)
+
+    def sequence(self, n):
+        if self.k + n > len(self.fx):
+            raise RuntimeError("trace exhausted after {} records".format(len(self.fx)))
+        res = np.array(self.fx[self.k:self.k + n])
+        self.k += n
+        return res
+
+    def nearest(self, x):
+        if not len(self.fx):
+            raise RuntimeError("empty trace")
+        x = np.asarray(x, dtype=np.float64).reshape(-1, self.x.shape[1])
+        if self.sq_norm is None:
+            self.sq_norm = np.concatenate([(self.x[i:i + self.chunk] ** 2).sum(axis=1)
+                                           for i in range(0, len(self.x), self.chunk)])
+
+        best = np.full(len(x), np.inf)
+        index = np.zeros(len(x), dtype=np.int64)
+        for i in range(0, len(self.x), self.chunk):
+            # the |x|^2 term is shared by every record and does not change the argmin
+            d = self.sq_norm[i:i + self.chunk] - 2 * x @ self.x[i:i + self.chunk].T
+            j = d.argmin(axis=1)
+            d = d[np.arange(len(x)), j]
+            better = d < best
+            best[better] = d[better]
+            index[better] = i + j[better]
+
+        return np.array(self.fx[index])
@@ -0,0 +1,35 @@
+import multiprocessing
+import numpy as np
+
+# problem replica held by each worker process, keyed by (suite_name, suite_options, problem_index)
+_replica = {}
+
+
+def _evaluate(task):
+    key, policy = task
+    if key not in _replica:
+        import cocoex
+        suite_name, suite_options, problem_index = key
+        _replica.clear()
+        suite = cocoex.Suite(suite_name, "", suite_options)
+        _replica[key] = (suite, suite.get_problem(problem_index))
+
+    _, problem = _replica[key]
+    return np.array([problem(x) for x in policy])
+
+
+class ParallelEvaluator(object):
+
+    def __init__(self, workers):
+        self.workers = workers
+        # fork before any CUDA context is created, the workers only run cocoex
+        self.pool = multiprocessing.get_context('fork').Pool(workers)
+
+    def __call__(self, key, policy):
+        chunks = np.array_split(policy, min(self.workers, len(policy)))
+        res = self.pool.map(_evaluate, [(key, chunk) for chunk in chunks])
+        return np.concatenate(res)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
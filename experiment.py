@@ -4,7 +4,9 @@ import numpy as np
 import torch
 from tensorboardX import SummaryWriter
 from trust_region_agent import TrustRegionAgent
+from batched_agent import BatchedTrustRegionAgent
 from config import consts, args, DirsAndLocksSingleton
+from analysis_store import load_series
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -112,6 +114,13 @@ class Experiment(object):
         else:
             raise NotImplementedError
 
+    def select_batch_agent(self):
+        agent_type = args.agent
+        if agent_type == 'trust':
+            return BatchedTrustRegionAgent
+        else:
+            raise NotImplementedError
+
     def bbo(self):
         self.agent = self.select_agent()(self.exp_name, self.env, checkpoint=self.checkpoint)
 
@@ -119,47 +128,77 @@ class Experiment(object):
         divergence = 0
 
         for _, bbo_results in (enumerate(player)):
-            avg_reward = torch.mean(bbo_results['rewards'][-1]).item()
-            logger.info("---------------- frame: {} - Problem ID :{} ---------------".format(bbo_results['frame'], self.problem_id))
-            logger.info("Problem iter index     :{}\t\tDim: {}\t\tDivergence: {} \t\tno_change: = {}".format(self.iter_index, self.action_space, bbo_results['divergence'], bbo_results['no_change']))
+            self.log_results(bbo_results)
+
+        self.end_bbo()
+        return divergence
+
+    @staticmethod
+    def bbo_batch(experiments):
+        # the problems of the experiments are optimized together by a single batched agent
+        exp = experiments[0]
+        agent = exp.select_batch_agent()(exp.exp_name, [e.env for e in experiments], checkpoint=exp.checkpoint)
+        for e, member in zip(experiments, agent.members):
+            e.agent = member
+
+        player = agent.minimize()
+        divergence = 0
+
+        for k, bbo_results in player:
+            experiments[k].log_results(bbo_results)
+
+        for e in experiments:
+            e.end_bbo()
+        return divergence
+
+    def log_results(self, bbo_results):
+        avg_reward = torch.mean(bbo_results['rewards'][-1]).item()
+        logger.info("---------------- frame: {} - Problem ID :{} ---------------".format(bbo_results['frame'], self.problem_id))
+        logger.info("Problem iter index     :{}\t\tDim: {}\t\tDivergence: {} \t\tno_change: = {}".format(self.iter_index, self.action_space, bbo_results['divergence'], bbo_results['no_change']))
+        if self.algorithm in ['EGL']:
+            logger.info("Statistics: mean_grad = %.3f \t grad norm = %.3f \t avg_reward = %.3f| \t derivative_loss =  %.3f" % (bbo_results['mean_grad'], bbo_results['grad_norm'], avg_reward, bbo_results['derivative_loss']))
+        elif self.algorithm == ['IGL']:
+            logger.info("Statistics: value = %.3f \t reward = %.3f \t value_loss =  %.3f|" % (bbo_results['value'], avg_reward, bbo_results['value_loss']))
+        logger.info("Best observe  : %.3f \t Pi_evaluate: = %.3f| \tBest_pi_evaluate: = %.3f| \t best_reward: = %.3f" % (bbo_results['best_observed'], bbo_results['reward_pi_evaluate'][-1], bbo_results['best_pi_evaluate'], bbo_results['best_reward']))
+        logger.info("trust_region  : min_sigma: = %.3f \t\t |epsilon: = %.3f" % (bbo_results['min_trust_sigma'], bbo_results['epsilon']))
+        logger.info("r_norm        : mean: =%.3f    \t\t |sigma: =%.3f" % (bbo_results['r_norm_mean'], bbo_results['r_norm_sigma']))
+        if args.ensemble > 1:
+            logger.info("ensemble      : members: =%d    \t\t |spread: =%.3f" % (args.ensemble, bbo_results['ensemble_spread']))
+        if args.early_stop_patience > 0 and len(bbo_results['value_iterations']):
+            logger.info("learning      : iterations: =%.1f (max %d)" % (np.mean(bbo_results['value_iterations']), args.learn_iteration))
+
+        if args.debug and self.algorithm in ['IGL']:
+            self.value_vs_f_eval(bbo_results['frame'])
+
+        if args.debug and self.algorithm in ['EGL']:
+            self.grad_norm_on_f_eval(bbo_results['frame'])
+
+        # log to tensorboard
+        if args.tensorboard:
+            pi = bbo_results['policies'][-1].cpu().numpy()
+            pi_explore = torch.mean(bbo_results['explore_policies'][-1], dim=0).cpu().numpy()
+
+            self.writer.add_scalar('evaluation/divergence', bbo_results['divergence'], bbo_results['frame'])
+            if self.algorithm in ['IGL']:
+                self.writer.add_scalars('evaluation/value_reward', {'value': bbo_results['value'], 'reward_pi_evaluate': bbo_results['reward_pi_evaluate'][-1], 'best': bbo_results['best_observed']}, bbo_results['frame'])
+                self.writer.add_scalar('evaluation/value_loss', bbo_results['value_loss'], bbo_results['frame'])
             if self.algorithm in ['EGL']:
-                logger.info("Statistics: mean_grad = %.3f \t grad norm = %.3f \t avg_reward = %.3f| \t derivative_loss =  %.3f" % (bbo_results['mean_grad'], bbo_results['grad_norm'], avg_reward, bbo_results['derivative_loss']))
-            elif self.algorithm == ['IGL']:
-                logger.info("Statistics: value = %.3f \t reward = %.3f \t value_loss =  %.3f|" % (bbo_results['value'], avg_reward, bbo_results['value_loss']))
-            logger.info("Best observe  : %.3f \t Pi_evaluate: = %.3f| \tBest_pi_evaluate: = %.3f| \t best_reward: = %.3f" % (bbo_results['best_observed'], bbo_results['reward_pi_evaluate'][-1], bbo_results['best_pi_evaluate'], bbo_results['best_reward']))
-            logger.info("trust_region  : min_sigma: = %.3f \t\t |epsilon: = %.3f" % (bbo_results['min_trust_sigma'], bbo_results['epsilon']))
-            logger.info("r_norm        : mean: =%.3f    \t\t |sigma: =%.3f" % (bbo_results['r_norm_mean'], bbo_results['r_norm_sigma']))
-
-            if args.debug and self.algorithm in ['IGL']:
-                self.value_vs_f_eval(bbo_results['frame'])
-
-            if args.debug and self.algorithm in ['EGL']:
-                self.grad_norm_on_f_eval(bbo_results['frame'])
-
-            # log to tensorboard
-            if args.tensorboard:
-                pi = bbo_results['policies'][-1].cpu().numpy()
-                pi_explore = torch.mean(bbo_results['explore_policies'][-1], dim=0).cpu().numpy()
-
-                self.writer.add_scalar('evaluation/divergence', bbo_results['divergence'], bbo_results['frame'])
-                if self.algorithm in ['IGL']:
-                    self.writer.add_scalars('evaluation/value_reward', {'value': bbo_results['value'], 'reward_pi_evaluate': bbo_results['reward_pi_evaluate'][-1], 'best': bbo_results['best_observed']}, bbo_results['frame'])
-                    self.writer.add_scalar('evaluation/value_loss', bbo_results['value_loss'], bbo_results['frame'])
-                if self.algorithm in ['EGL']:
-                    self.writer.add_scalar('evaluation/grad_norm', bbo_results['grad_norm'], bbo_results['frame'])
-                    self.writer.add_scalar('evaluation/derivative_loss', bbo_results['derivative_loss'], bbo_results['frame'])
-                self.writer.add_scalars('evaluation/pi_evaluate_observe', {'evaluate': bbo_results['reward_pi_evaluate'][-1], 'best': bbo_results['best_observed']}, bbo_results['frame'])
-
-                for i in range(len(pi)):
-                    self.writer.add_scalars('evaluation/pi_' + str(i), {'pi': pi[i], 'explore': pi_explore[i]}, bbo_results['frame'])
-
-                if hasattr(self.agent, "pi_net"):
-                    self.writer.add_histogram("evaluation/pi_net", self.agent.pi_net.pi.clone().cpu().data.numpy(), bbo_results['frame'], 'fd')
-                if hasattr(self.agent, "value_net"):
-                    for name, param in self.agent.value_net.named_parameters():
-                        self.writer.add_histogram("evaluation/value_net/%s" % name, param.clone().cpu().data.numpy(), bbo_results['frame'], 'fd')
+                self.writer.add_scalar('evaluation/grad_norm', bbo_results['grad_norm'], bbo_results['frame'])
+                self.writer.add_scalar('evaluation/derivative_loss', bbo_results['derivative_loss'], bbo_results['frame'])
+            self.writer.add_scalars('evaluation/pi_evaluate_observe', {'evaluate': bbo_results['reward_pi_evaluate'][-1], 'best': bbo_results['best_observed']}, bbo_results['frame'])
+
+            for i in range(len(pi)):
+                self.writer.add_scalars('evaluation/pi_' + str(i), {'pi': pi[i], 'explore': pi_explore[i]}, bbo_results['frame'])
 
+            if hasattr(self.agent, "pi_net"):
+                self.writer.add_histogram("evaluation/pi_net", self.agent.pi_net.pi.clone().cpu().data.numpy(), bbo_results['frame'], 'fd')
+            if hasattr(self.agent, "value_net"):
+                for name, param in self.agent.value_net.named_parameters():
+                    self.writer.add_histogram("evaluation/value_net/%s" % name, param.clone().cpu().data.numpy(), bbo_results['frame'], 'fd')
+
+    def end_bbo(self):
         print("End BBO evaluation")
+        self.agent.checkpoint_writer.flush()
         # try:
         #     self.compare_pi_evaluate()
         # except:
@@ -181,7 +220,6 @@ class Experiment(object):
                 self.plot_2D_contour()
         except:
             pass
-        return divergence
 
     def value_vs_f_eval(self, n):
         path_res = os.path.join(consts.baseline_dir, 'f_eval', '{}D'.format(self.action_space), '{}D_index_{}.pkl'.format(self.action_space, self.iter_index))
@@ -262,8 +300,8 @@ class Experiment(object):
         path_res = os.path.join(path_dir, '2D_index_{}.npy'.format(self.iter_index))
         res = np.load(path_res, allow_pickle=True).item()
 
-        x = 5*np.load(os.path.join(path, 'policies.npy'), allow_pickle=True)
-        x_exp = 5*np.load(os.path.join(path, 'explore_policies.npy'), allow_pickle=True)
+        x = 5*load_series(path, 'policies')
+        x_exp = 5*load_series(path, 'explore_policies')
 
         fig, ax = plt.subplots()
         cs = ax.contour(res['x0'], res['x1'], res['z'], 100)
@@ -289,10 +327,10 @@ class Experiment(object):
     #     f0 = optimizer_res['f0'][0]
     #
     #     path = os.path.join(self.dirs_locks.analysis_dir, str(self.iter_index))
-    #     pi_eval = np.load(os.path.join(path, 'reward_pi_evaluate.npy'), allow_pickle=True)
-    #     frame_eval = np.load(os.path.join(path, 'frame_pi_evaluate.npy'), allow_pickle=True)
-    #     pi_best = np.load(os.path.join(path, 'best_observed.npy'), allow_pickle=True)
-    #     frame = np.load(os.path.join(path, 'frame.npy'), allow_pickle=True)
+    #     pi_eval = load_series(path, 'reward_pi_evaluate')
+    #     frame_eval = load_series(path, 'frame_pi_evaluate')
+    #     pi_best = load_series(path, 'best_observed')
+    #     frame = load_series(path, 'frame')
     #
     #     min_val = min(min_val, min(pi_best))
     #
@@ -327,9 +365,9 @@ class Experiment(object):
 
     def mean_grad_and_divergence(self):
         path = os.path.join(self.dirs_locks.analysis_dir, str(self.iter_index))
-        mean_grad = np.load(os.path.join(path, 'mean_grad.npy'), allow_pickle=True)
-        divergence = np.load(os.path.join(path, 'divergence.npy'), allow_pickle=True)
-        frame = np.load(os.path.join(path, 'frame.npy'), allow_pickle=True)
+        mean_grad = load_series(path, 'mean_grad')
+        divergence = load_series(path, 'divergence')
+        frame = load_series(path, 'frame')
 
         fig, ax = plt.subplots()
 
@@ -353,9 +391,9 @@ class Experiment(object):
 
     def r_norm_vs_divergence(self):
         path = os.path.join(self.dirs_locks.analysis_dir, str(self.iter_index))
-        norm_rewards = np.load(os.path.join(path, 'norm_rewards.npy'), allow_pickle=True)
-        divergence = np.load(os.path.join(path, 'divergence.npy'), allow_pickle=True)
-        frame = np.load(os.path.join(path, 'frame.npy'), allow_pickle=True)
+        norm_rewards = load_series(path, 'norm_rewards')
+        divergence = load_series(path, 'divergence')
+        frame = load_series(path, 'frame')
 
         fig, ax = plt.subplots()
 
@@ -9,7 +9,11 @@ import pwd
 import random
 import numpy as np
 from vae import VaeProblem, VAE
-from environment import EnvCoco, EnvVae, EnvOneD
+from environment import EnvCoco, EnvVae, EnvOneD, EnvReplay, EnvAsync
+from evaluator import ParallelEvaluator
+from async_evaluator import AsyncEvaluator, HttpObjective
+from evaluation_trace import TraceWriter, trace_path
+from bbob import BBOBProblem
 from collections import defaultdict
 import traceback
 
@@ -27,27 +31,65 @@ class MainRun(object):
     def __init__(self):
         self.action_space = args.action_space
         self.problem = None
+        self.env = None
+        self.envs = []
+        self.evaluator = None
         if self.action_space != 784:
             suite_name = "bbob"
             suite_filter_options = ("dimensions: " + str(max(self.action_space, 2)))
             self.suite = cocoex.Suite(suite_name, "", suite_filter_options)
+            if args.async_objective and self.action_space != 1 and not args.replay_trace:
+                self.evaluator = AsyncEvaluator(HttpObjective(args.async_objective), concurrency=args.async_concurrency,
+                                                timeout=args.async_timeout, retries=args.async_retries)
+            elif args.eval_workers > 1 and args.bbob_engine == 'coco' and not args.replay_trace:
+                self.evaluator = ParallelEvaluator(args.eval_workers)
 
     def reset(self, problem_index):
-        if self.action_space == 784:
-            self.problem = VaeProblem(problem_index)
-        else:
+        self.reset_batch([problem_index])
+
+    def reset_batch(self, problem_indices):
+        self.close_trace()
+        if self.action_space != 784:
             self.suite.reset()
-            self.problem = self.suite.get_problem(problem_index)
 
-        self.set_env(problem_index)
+        self.envs = []
+        for problem_index in problem_indices:
+            if self.action_space == 784:
+                self.problem = VaeProblem(problem_index)
+            else:
+                self.problem = self.suite.get_problem(problem_index)
+                if args.bbob_engine == 'numpy':
+                    self.problem = BBOBProblem.from_id(self.problem.id, index=self.problem.index)
+
+            self.set_env(problem_index)
+            self.envs.append(self.env)
 
     def set_env(self, problem_index):
         if self.action_space == 784:
             self.env = EnvVae(self.problem, problem_index, to_numpy=True)
         elif self.action_space == 1:
-            self.env = EnvOneD(self.problem, problem_index, need_norm=True, to_numpy=True)
+            self.env = EnvOneD(self.problem, problem_index, need_norm=True, to_numpy=True, evaluator=self.evaluator)
+        elif args.replay_trace:
+            path = trace_path(args.replay_trace, 'coco_' + str(self.problem.id))
+            self.env = EnvReplay(self.problem, problem_index, need_norm=True, to_numpy=True, path=path, mode=args.replay_mode)
+        elif args.async_objective:
+            self.env = EnvAsync(self.problem, problem_index, need_norm=True, to_numpy=True, evaluator=self.evaluator)
         else:
-            self.env = EnvCoco(self.problem, problem_index, need_norm=True, to_numpy=True)
+            self.env = EnvCoco(self.problem, problem_index, need_norm=True, to_numpy=True, evaluator=self.evaluator)
+
+        if args.trace_dir:
+            self.env.trace = TraceWriter(trace_path(args.trace_dir, self.env.get_problem_id()), self.env.output_size,
+                                         append=args.load_last_model)
+
+    def close_trace(self):
+        for env in self.envs:
+            if env.trace is not None:
+                env.trace.close()
+
+    def close(self):
+        self.close_trace()
+        if self.evaluator is not None:
+            self.evaluator.close()
 
 def main():
 
@@ -81,26 +123,34 @@ def main():
             except:
                 pass
 
-        for i in problems_to_run:
-            main_run.reset(i)
-            divergence = run_exp(main_run.env)
-
-            data['iter_index'].append(i)
-            data['divergence'].append(divergence)
-            data['index'].append(main_run.env.problem.index)
-            data['hit'].append(main_run.env.problem.final_target_hit)
-            data['id'].append(main_run.env.get_problem_id())
-            data['dimension'].append(main_run.env.problem.dimension)
-            data['best_observed'].append(main_run.env.problem.best_observed_fvalue1)
-            data['initial_solution'].append(main_run.env.initial_solution)
-            data['upper_bound'].append(main_run.env.upper_bounds)
-            data['lower_bound'].append(main_run.env.lower_bounds)
-            data['number_of_evaluations'].append(main_run.env.problem.evaluations)
+        for b in range(0, len(problems_to_run), args.batch_problems):
+            problem_indices = problems_to_run[b:b + args.batch_problems]
+            main_run.reset_batch(problem_indices)
+            if len(main_run.envs) > 1:
+                divergence = run_batch(main_run.envs)
+            else:
+                divergence = run_exp(main_run.env)
+
+            for i, env in zip(problem_indices, main_run.envs):
+                data['iter_index'].append(i)
+                data['divergence'].append(divergence)
+                data['index'].append(env.problem.index)
+                data['hit'].append(env.final_target_hit)
+                data['id'].append(env.get_problem_id())
+                data['dimension'].append(env.problem.dimension)
+                data['best_observed'].append(env.best_observed_fvalue1)
+                data['initial_solution'].append(env.initial_solution)
+                data['upper_bound'].append(env.upper_bounds)
+                data['lower_bound'].append(env.lower_bounds)
+                data['number_of_evaluations'].append(env.evaluations)
+                if env.cache is not None:
+                    data['cache_hits'].append(env.cache.hits)
 
             df = pd.DataFrame(data)
             fmin_file = os.path.join(res_dir, run_id + '_' + str(args.action_space) + '.csv')
             df.to_csv(fmin_file)
 
+    main_run.close()
     logger.info("End of simulation divergence = {}".format(divergence))
 
 def run_exp(env):
@@ -113,6 +163,16 @@ def run_exp(env):
         logger.info(traceback.format_exc())
     return divergence
 
+def run_batch(envs):
+    divergence = 0
+    experiments = [Experiment(logger.filename, env) for env in envs]
+    logger.info("BBO Session of {} batched problems with NEURAL NET, it might take a while".format(len(envs)))
+    try:
+        divergence = Experiment.bbo_batch(experiments)
+    except Exception as e:
+        logger.info(traceback.format_exc())
+    return divergence
+
 if __name__ == '__main__':
     main()
 
@@ -2,8 +2,10 @@ import torch
 from torch import nn
 from config import args
 import math
+import copy
 from collections import defaultdict
 from torch.nn.utils import spectral_norm
+from torch.autograd.function import once_differentiable
 
 action_space = args.action_space
 delta = 10 # quantization levels / 2
@@ -25,17 +27,103 @@ def init_weights(net, init='ortho'):
         net.param_count += sum([p.data.nelement() for p in module.parameters()])
 
 
+def order_statistics(x, ks):
+    # k-th smallest values (1-based, as in torch.kthvalue) of a 1-D tensor from a single sort on its device
+    x = torch.sort(x)[0]
+    return [x[min(max(k, 1), len(x)) - 1] for k in ks]
+
+
+class P2Quantile(object):
+
+    # Streaming P^2 estimator (Jain & Chlamtac, 1985) of several quantiles of a scalar stream. Each quantile
+    # keeps five markers whose heights are updated on the device, so no observation is copied to the host, and a
+    # batch costs a fixed number of tensor ops whatever its size. The per batch order statistics stay the default,
+    # the sketch is the memory bounded alternative.
+
+    def __init__(self, probs, device=None, dtype=torch.float):
+        p = torch.tensor(probs, dtype=dtype, device=device).unsqueeze(1)
+        self.dn = torch.cat([torch.zeros_like(p), p / 2, p, (1 + p) / 2, torch.ones_like(p)], dim=1)
+        self.desired_init = torch.cat([torch.ones_like(p), 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5 * torch.ones_like(p)], dim=1)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.init = []
+        self.q = None
+        self.pos = None
+        self.desired = None
+
+    def state_dict(self):
+        return {'count': self.count, 'init': self.init, 'q': self.q, 'pos': self.pos, 'desired': self.desired}
+
+    def load_state_dict(self, state):
+        self.count = state['count']
+        self.init = list(state['init'])
+        self.q = state['q']
+        self.pos = state['pos']
+        self.desired = state['desired']
+
+    def update(self, x):
+        x = x.detach().view(-1).to(self.dn.dtype)
+        if self.q is None:
+            self.init.append(x[:5 - self.count])
+            self.count += len(self.init[-1])
+            x = x[len(self.init[-1]):]
+            if self.count < 5:
+                return
+            self.q = torch.sort(torch.cat(self.init))[0].expand_as(self.dn).clone()
+            self.pos = torch.arange(1, 6, dtype=self.dn.dtype, device=self.dn.device).expand_as(self.dn).clone()
+            self.desired = self.desired_init.clone()
+            self.init = []
+        if len(x):
+            self.insert(x)
+            self.count += len(x)
+
+    def insert(self, x):
+        # a whole batch at once: the marker positions advance by the number of observations below them and every
+        # middle marker then moves by the integer part of its distance from the desired position, as far as its
+        # neighbours allow, to the height of the parabola through the neighbours (P^2 with steps larger than one)
+        q, pos = self.q, self.pos
+        q[:, 0] = torch.min(q[:, 0], x.min())
+        q[:, 4] = torch.max(q[:, 4], x.max())
+        pos[:, 1:4] += (x < q[:, 1:4].unsqueeze(2)).sum(dim=2).to(pos.dtype)
+        pos[:, 4] += len(x)
+        self.desired += len(x) * self.dn
+
+        for i in range(1, 4):
+            d = torch.trunc(self.desired[:, i] - pos[:, i])
+            d = torch.min(torch.max(d, pos[:, i - 1] - pos[:, i] + 1), pos[:, i + 1] - pos[:, i] - 1)
+            parabolic = q[:, i] + d / (pos[:, i + 1] - pos[:, i - 1]) * (
+                (pos[:, i] - pos[:, i - 1] + d) * (q[:, i + 1] - q[:, i]) / (pos[:, i + 1] - pos[:, i])
+                + (pos[:, i + 1] - pos[:, i] - d) * (q[:, i] - q[:, i - 1]) / (pos[:, i] - pos[:, i - 1]))
+            up = d > 0
+            neighbour_q = torch.where(up, q[:, i + 1], q[:, i - 1])
+            neighbour_pos = torch.where(up, pos[:, i + 1], pos[:, i - 1])
+            linear = q[:, i] + d * (neighbour_q - q[:, i]) / (neighbour_pos - pos[:, i])
+            height = torch.where((q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1]), parabolic, linear)
+            q[:, i] = torch.where(d != 0, height, q[:, i])
+            pos[:, i] += d
+
+    def quantiles(self):
+        if self.q is None:
+            x = torch.sort(torch.cat(self.init))[0]
+            index = torch.round((self.dn[:, 2] * (len(x) - 1))).long()
+            return x[index]
+        return self.q[:, 2]
+
+
 class RobustNormalizer2(object):
 
-    def __init__(self, outlier=0.1, lr=0.1):
+    def __init__(self, outlier=0.1, lr=0.1, device=None, sketch=False):
         self.outlier = outlier
         self.lr = lr
-        self.eps = 1e-5*torch.cuda.FloatTensor([1])
+        self.eps = 1e-5*torch.ones(1, device=device)
         self.squash_eps = 1e-5
         self.m = None
         self.n = None
         self.mu = None
         self.sigma = None
+        self.sketch = P2Quantile([outlier, 1 - outlier], device=device) if sketch else None
 
         self.y1 = -1
         self.y2 = 1
@@ -43,6 +131,17 @@ class RobustNormalizer2(object):
     def reset(self):
         self.m = None
         self.n = None
+        if self.sketch is not None:
+            self.sketch.reset()
+
+    def state_dict(self):
+        return {'m': self.m, 'n': self.n, 'mu': self.mu, 'sigma': self.sigma,
+                'sketch': self.sketch.state_dict() if self.sketch is not None else None}
+
+    def load_state_dict(self, state):
+        self.m, self.n, self.mu, self.sigma = state['m'], state['n'], state['mu'], state['sigma']
+        if self.sketch is not None:
+            self.sketch.load_state_dict(state['sketch'])
 
     def squash_derivative(self, x):
         return x
@@ -75,17 +174,16 @@ class RobustNormalizer2(object):
 
     def __call__(self, x, training=False):
         if training:
-            n = len(x)
-            outlier = int(n * self.outlier + .5)
-
-            x_cpu = x.cpu()
-
-            x2_ind = torch.kthvalue(x_cpu, n - outlier, dim=0)[1]
-            x1_ind = torch.kthvalue(x_cpu, outlier, dim=0)[1]
-            # curr_mu = torch.median(x_cpu, dim=0)[1]
+            if self.sketch is not None:
+                self.sketch.update(x)
+                x1, x2 = self.sketch.quantiles()
+            else:
+                n = len(x)
+                outlier = int(n * self.outlier + .5)
+                x1, x2 = order_statistics(x, [outlier, n - outlier])
 
-            m = (self.y2 - self.y1) / (x[x2_ind] - x[x1_ind] + self.eps)
-            n = self.y2 - m * x[x2_ind]
+            m = (self.y2 - self.y1) / (x2 - x1 + self.eps)
+            n = self.y2 - m * x2
 
             if self.m is None or self.n is None:
                 self.m = m
@@ -95,7 +193,7 @@ class RobustNormalizer2(object):
                 self.n = (1 - self.lr) * self.n + self.lr * n
 
             self.mu = - self.n / (self.m + self.eps)
-            self.sigma = max(1 / self.m, self.eps)
+            self.sigma = torch.max(1 / self.m, self.eps)
 
         else:
             x = self.squash(x)
@@ -110,6 +208,12 @@ class NoRobustNormalizer(object):
     def reset(self):
         return
 
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        return
+
     def squash_derivative(self, x):
         return x
 
@@ -127,22 +231,23 @@ class NoRobustNormalizer(object):
 
 class RobustNormalizer(object):
 
-    def __init__(self, outlier=0.1, delta=1, lr=0.1):
+    def __init__(self, outlier=0.1, delta=1, lr=0.1, device=None, sketch=False):
         self.outlier = outlier
         self.delta = delta
         self.lr = lr
         self.temp_squash = nn.Tanh()
-        self.eps = 1e-5*torch.cuda.FloatTensor([1])
+        self.eps = 1e-5*torch.ones(1, device=device)
         self.squash_eps = 1e-9
         self.mu = None
         self.sigma = None
         self.alpha = 0.1
+        self.sketch = P2Quantile([outlier, 0.5, 1 - outlier], device=device) if sketch else None
 
-        if args.trust_alg == 'relu':
+        if args.r_norm_alg == 'relu':
             self.squash = self.squash_relu
             self.desquash = self.desquash_relu
             self.squash_derivative = self.squash_derivative_relu
-        elif args.trust_alg == 'tanh':
+        elif args.r_norm_alg == 'tanh':
             self.squash = self.squash_tanh
             self.desquash = self.desquash_tanh
             self.squash_derivative = self.squash_derivative_tanh
@@ -150,6 +255,16 @@ class RobustNormalizer(object):
     def reset(self):
         self.mu = None
         self.sigma = None
+        if self.sketch is not None:
+            self.sketch.reset()
+
+    def state_dict(self):
+        return {'mu': self.mu, 'sigma': self.sigma, 'sketch': self.sketch.state_dict() if self.sketch is not None else None}
+
+    def load_state_dict(self, state):
+        self.mu, self.sigma = state['mu'], state['sigma']
+        if self.sketch is not None:
+            self.sketch.load_state_dict(state['sketch'])
 
     def squash_tanh(self, x):
         x = (x - self.mu) / (self.sigma + self.eps)
@@ -183,15 +298,15 @@ class RobustNormalizer(object):
 
     def __call__(self, x, training=False):
         if training:
-            n = len(x)
-            outlier = int(n * self.outlier + .5)
-
-            x_cpu = x.cpu()
-            up = torch.kthvalue(x_cpu, n - outlier, dim=0)[1]
-            down = torch.kthvalue(x_cpu, outlier + 1, dim=0)[1]
-
-            mu = torch.median(x, dim=0)[0]
-            sigma = (x[up] - x[down]) * self.delta
+            if self.sketch is not None:
+                self.sketch.update(x)
+                down, mu, up = self.sketch.quantiles()
+            else:
+                n = len(x)
+                outlier = int(n * self.outlier + .5)
+                # torch.median returns the lower median
+                down, mu, up = order_statistics(x, [outlier + 1, (n + 1) // 2, n - outlier])
+            sigma = (up - down) * self.delta
 
             if self.mu is None or self.sigma is None:
                 self.mu = mu
@@ -200,7 +315,7 @@ class RobustNormalizer(object):
                 self.mu = (1 - self.lr) * self.mu + self.lr * mu
                 self.sigma = (1 - self.lr) * self.sigma + self.lr * sigma
 
-            self.sigma = max(self.sigma, self.eps)
+            self.sigma = torch.max(self.sigma, self.eps)
 
         else:
             x = self.squash(x)
@@ -214,6 +329,20 @@ class TrustRegion(object):
         self.pi_net = pi_net
         self.min_sigma = 0.1*torch.ones_like(pi_net.pi)
         self.trust_factor = args.trust_factor
+        # per dimension counts of the squeeze outcomes
+        self.in_region = torch.zeros_like(pi_net.pi, dtype=torch.int64)
+        self.global_boundary = torch.zeros_like(pi_net.pi, dtype=torch.int64)
+        self.local_boundary = torch.zeros_like(pi_net.pi, dtype=torch.int64)
+
+    def state_dict(self):
+        return {'mu': self.mu, 'sigma': self.sigma, 'in_region': self.in_region,
+                'global_boundary': self.global_boundary, 'local_boundary': self.local_boundary}
+
+    def load_state_dict(self, state):
+        self.mu, self.sigma = state['mu'], state['sigma']
+        self.in_region = state['in_region']
+        self.global_boundary = state['global_boundary']
+        self.local_boundary = state['local_boundary']
 
     def bounderies(self):
         lower, upper = (self.mu - self.sigma), (self.mu + self.sigma)
@@ -223,18 +352,17 @@ class TrustRegion(object):
 
     def squeeze(self, pi):
 
-        for i in range(len(pi)):
-            if pi[i] < self.mu[i] + (1 - self.min_sigma[i]) * self.sigma[i] or pi[i] > self.mu[i] - (1 - self.min_sigma[i]) * self.sigma[i]:
-                self.sigma[i] = self.trust_factor * self.sigma[i]
-                #print("index {}: In trust region".format(i))
-            else:
-                assert (self.mu[i] - self.sigma[i] >= -1), "mu - sigma < -1"
-                assert (self.mu[i] + self.sigma[i] <= 1), "mu + sigma > 1"
-                if self.mu[i] - self.sigma[i] == -1 or self.mu[i] + self.sigma[i] == 1:
-                    self.sigma[i] = self.trust_factor * self.sigma[i]
-                    print("index {}: On global boundary".format(i))
-                else:
-                    print("index {}: On local boundary".format(i))
+        in_region = (pi < self.mu + (1 - self.min_sigma) * self.sigma) | (pi > self.mu - (1 - self.min_sigma) * self.sigma)
+        on_boundary = ~in_region
+        # a single host sync for the bounds of all the dimensions
+        in_bounds = (self.mu - self.sigma >= -1) & (self.mu + self.sigma <= 1)
+        assert (in_region | in_bounds).all(), "mu - sigma < -1 or mu + sigma > 1"
+        global_boundary = on_boundary & ((self.mu - self.sigma == -1) | (self.mu + self.sigma == 1))
+
+        self.sigma = torch.where(in_region | global_boundary, self.trust_factor * self.sigma, self.sigma)
+        self.in_region += in_region
+        self.global_boundary += global_boundary
+        self.local_boundary += on_boundary & ~global_boundary
 
         self.mu = pi
 
@@ -272,6 +400,12 @@ class NoTrustRegion(object):
         self.sigma = torch.ones_like(pi_net.pi)
         self.pi_net = pi_net
 
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        return
+
     def bounderies(self):
         lower, upper = (self.mu - self.sigma), (self.mu + self.sigma)
         assert lower.min().item() >= -1, "lower min {}".format(lower.min())
@@ -316,11 +450,59 @@ class MultipleOptimizer:
         op_dict = defaultdict()
         for i, op in enumerate(self.optimizers):
             op_dict[str(i)] = op.state_dict()
+        return op_dict
 
     def load_state_dict(self, op_dict):
         for i, op in enumerate(self.optimizers):
             op.load_state_dict(op_dict[str(i)])
 
+class EarlyStopping(object):
+
+    def __init__(self, patience, min_iter=1, delta=0.):
+        self.patience = patience
+        self.min_iter = min_iter
+        self.delta = delta
+        self.reset()
+
+    def reset(self):
+        self.best = math.inf
+        self.no_improvement = 0
+        self.iterations = 0
+
+    def __call__(self, loss):
+        self.iterations += 1
+        if loss < self.best - self.delta * abs(self.best):
+            self.best = loss
+            self.no_improvement = 0
+        else:
+            self.no_improvement += 1
+        return self.iterations >= self.min_iter and self.no_improvement >= self.patience
+
+class CompiledStep(object):
+    # forward, loss and backward of a training step, the loss function is compiled with torch.compile
+    # (the backward graph is compiled on its first use) and runs eagerly when compilation fails
+
+    def __init__(self, f, zero_grad, enable=True):
+        self.f = f
+        self.zero_grad = zero_grad
+        self.loss = torch.compile(f, dynamic=False) if enable and hasattr(torch, 'compile') else f
+
+    def __call__(self, *args):
+        if self.loss is not self.f:
+            try:
+                loss = self.loss(*args)
+                loss.backward()
+                return loss.detach()
+            except Exception as e:
+                print("Compiled step failed, falling back to eager: {}".format(str(e).splitlines()[0]))
+                self.loss = self.f
+                # a failure in the compiled backward can leave part of the gradients of the step accumulated
+                self.zero_grad()
+
+        loss = self.f(*args)
+        loss.backward()
+        return loss.detach()
+
 class SplineNet(nn.Module):
 
     def __init__(self, device, pi_net, output=1):
@@ -342,44 +524,96 @@ class SplineNet(nn.Module):
 
         return x
 
+class StackedSplineNet(nn.Module):
+
+    # independently initialized SplineNets with a shared embedding table and heads stacked along a leading
+    # member axis, the heads of all the members run in the same kernels with torch.func.vmap
+
+    def __init__(self, device, ensemble, output=1):
+        super(StackedSplineNet, self).__init__()
+        self.normalize = nn.Tanh()
+        self.embedding = SplineEmbedding(device, ensemble)
+        heads = [SplineHead(output) for _ in range(ensemble)]
+        params, _ = torch.func.stack_module_state(heads)
+        self.names = list(params.keys())
+        self.head = nn.ParameterList([nn.Parameter(params[name].detach()) for name in self.names])
+        # a plain list, the weights of the base head are never used
+        self.base = [copy.deepcopy(heads[0]).to('meta')]
+        self.output = output
+
+    def head_forward(self, params, x, x_emb):
+        return torch.func.functional_call(self.base[0], dict(zip(self.names, params)), (x, x_emb))
+
+    def forward(self, x, normalize=True):
+        # x: members x batch x action_space
+        if normalize:
+            x = self.normalize(x)
+
+        x = torch.clamp(x, max=1-1e-3)
+
+        x_emb = self.embedding(x)
+        return torch.func.vmap(self.head_forward)(tuple(self.head), x, x_emb)
+
+class SplineInterpolation(torch.autograd.Function):
+
+    # (1 - t) * weight[index] + t * weight[index + stride]: both knots are read by a single index_select and the
+    # gradient of the table is the sparse tensor of the read rows, as the one of a sparse nn.Embedding
+
+    @staticmethod
+    def forward(ctx, t, weight, index, stride):
+        rows = index.reshape(-1)
+        rows = torch.cat([rows, rows + stride])
+        knots = weight.index_select(0, rows).view((2,) + index.shape + (weight.shape[1],))
+        h = torch.lerp(knots[0], knots[1], t.unsqueeze(-1))
+
+        ctx.save_for_backward(t, rows, knots if ctx.needs_input_grad[0] else None)
+        ctx.weight_shape = weight.shape
+        return h
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad):
+        t, rows, knots = ctx.saved_tensors
+        grad_t = grad_weight = None
+
+        if ctx.needs_input_grad[0]:
+            grad_t = (grad * (knots[1] - knots[0])).sum(dim=-1)
+
+        if ctx.needs_input_grad[1]:
+            t = t.unsqueeze(-1)
+            values = torch.stack([grad - grad * t, grad * t]).view(len(rows), -1)
+            grad_weight = torch.sparse_coo_tensor(rows.unsqueeze(0), values, ctx.weight_shape, check_invariants=False)
+
+        return grad_t, grad_weight, None, None
+
 class SplineEmbedding(nn.Module):
 
-    def __init__(self, device):
+    def __init__(self, device, ensemble=1):
         super(SplineEmbedding, self).__init__()
 
         self.delta = delta
         self.actions = action_space
         self.emb = 32
         self.device = device
+        self.ensemble = ensemble
 
         self.ind_offset = torch.arange(self.actions, dtype=torch.int64).to(device).unsqueeze(0)
+        # an ensemble keeps the tables of its members one after the other, x is then members x n x actions
+        rows = (2 * self.delta + 1) * self.actions
+        self.member_offset = (rows * torch.arange(ensemble, dtype=torch.int64)).to(device).view(-1, 1, 1)
 
-        self.b = nn.Embedding((2 * self.delta + 1) * self.actions, self.emb, sparse=True)
+        self.b = nn.Embedding(ensemble * rows, self.emb, sparse=True)
 
     def forward(self, x):
-        n = len(x)
-
-        xl = (x * self.delta).floor()
-        xli = self.actions * (xl.long() + self.delta) + self.ind_offset
-        xl = xl / self.delta
-        xli = xli.view(-1)
-
-        xh = (x * self.delta + 1).floor()
-        xhi = self.actions * (xh.long() + self.delta) + self.ind_offset
-        xh = xh / self.delta
-        xhi = xhi.view(-1)
-
-        bl = self.b(xli).view(n, self.actions, self.emb)
-        bh = self.b(xhi).view(n, self.actions, self.emb)
+        # the knots below and above x are the rows index and index + actions of the table, t is the position of x
+        # between them. The gradient of x flows through t.
+        x = x * self.delta
+        xl = x.floor()
+        index = self.actions * (xl.long() + self.delta) + self.ind_offset
+        if self.ensemble > 1:
+            index = index + self.member_offset
 
-        delta = 1 / self.delta
-
-        x = x.unsqueeze(2)
-        xl = xl.unsqueeze(2)
-        xh = xh.unsqueeze(2)
-
-        h = bh / delta * (x - xl) + bl / delta * (xh - x)
-        return h
+        return SplineInterpolation.apply(x - xl, self.b.weight, index, self.actions)
 
 class SplineHead(nn.Module):
 
@@ -519,6 +753,192 @@ class DuelNet(nn.Module):
 
         return x
 
+class StackedDuelNet(nn.Module):
+
+    # DuelNets of several problems with their weights stacked along a leading problem axis, every layer of
+    # all the problems is a single batched matmul. The initial weights are copied from the given nets.
+
+    def __init__(self, nets):
+        super(StackedDuelNet, self).__init__()
+        self.normalize = nn.Tanh()
+        self.problems = len(nets)
+        layers = [[m for m in net.fc if isinstance(m, nn.Linear)] for net in nets]
+        self.weight = nn.ParameterList([nn.Parameter(torch.stack([l[i].weight.detach().t() for l in layers]))
+                                        for i in range(len(layers[0]))])
+        self.bias = nn.ParameterList([nn.Parameter(torch.stack([l[i].bias.detach() for l in layers]).unsqueeze(1))
+                                      for i in range(len(layers[0]))])
+        # state_dict keys of a single DuelNet, checkpoints of a problem stay loadable by DuelNet
+        self.keys = [(name + '.weight', name + '.bias') for name, m in nets[0].named_modules() if isinstance(m, nn.Linear)]
+
+    def forward(self, pi, index=None, normalize=True):
+        # pi: problems x batch x action_space, index selects a subset of the problems
+        if normalize:
+            pi = self.normalize(pi)
+        x = pi
+        for i, (w, b) in enumerate(zip(self.weight, self.bias)):
+            if index is not None:
+                w, b = w[index], b[index]
+            x = torch.baddbmm(b, x, w)
+            if i < len(self.weight) - 1:
+                x = torch.relu(x)
+        return x
+
+    def member_forward(self, k, pi):
+        x = pi
+        for i, (w, b) in enumerate(zip(self.weight, self.bias)):
+            x = torch.addmm(b[k], x, w[k])
+            if i < len(self.weight) - 1:
+                x = torch.relu(x)
+        return x
+
+    def member_state_dict(self, k):
+        state = {}
+        for (weight_key, bias_key), w, b in zip(self.keys, self.weight, self.bias):
+            state[weight_key] = w[k].detach().t().clone()
+            state[bias_key] = b[k, 0].detach().clone()
+        return state
+
+    def load_member_state_dict(self, k, state):
+        with torch.no_grad():
+            for (weight_key, bias_key), w, b in zip(self.keys, self.weight, self.bias):
+                w[k] = state[weight_key].t()
+                b[k, 0] = state[bias_key]
+
+
+class StackedDuelNetMember(nn.Module):
+
+    # the DuelNet of a single problem of a StackedDuelNet, its state_dict is the state_dict of that DuelNet
+
+    def __init__(self, net, k, pi_net):
+        super(StackedDuelNetMember, self).__init__()
+        # a plain reference, the stacked weights are not parameters of the member
+        self.__dict__['net'] = net
+        self.k = k
+        self.pi_net = pi_net
+
+    def forward(self, pi, normalize=True):
+        pi = pi.view(-1, action_space)
+        if normalize:
+            pi = self.pi_net(pi)
+        return self.net.member_forward(self.k, pi)
+
+    def state_dict(self, *args, **kwargs):
+        state = super(StackedDuelNetMember, self).state_dict(*args, **kwargs)
+        state.update(self.net.member_state_dict(self.k))
+        return state
+
+    def load_state_dict(self, state, strict=True):
+        keys = set(key for pair in self.net.keys for key in pair)
+        self.net.load_member_state_dict(self.k, state)
+        return super(StackedDuelNetMember, self).load_state_dict({k: v for k, v in state.items() if k not in keys}, strict)
+
+
+class Ensemble(nn.Module):
+
+    # a surrogate made of the stacked members of a StackedDuelNet or a StackedSplineNet, it predicts the mean of
+    # its members and each member is trained on its own minibatches
+
+    def __init__(self, net, ensemble):
+        super(Ensemble, self).__init__()
+        self.net = net
+        self.ensemble = ensemble
+
+    def members(self, pi, normalize=True):
+        # pi: batch x action_space for the same input to all the members or members x batch x action_space
+        if pi.dim() < 3:
+            pi = pi.reshape(-1, action_space).expand(self.ensemble, -1, -1)
+        return self.net(pi, normalize=normalize)
+
+    def forward(self, pi, normalize=True):
+        return self.members(pi, normalize).mean(dim=0)
+
+    def spread(self, pi, normalize=True):
+        return self.members(pi, normalize).std(dim=0)
+
+
+class StackedAdam(object):
+
+    # Adam over parameters stacked along a leading problem axis, a step only updates the problems of its mask.
+    # Every problem keeps its own step count so the update of a problem is the update of a separate Adam.
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        self.params = list(params)
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.steps = torch.zeros(len(self.params[0]), device=self.params[0].device)
+        self.exp_avg = [torch.zeros_like(p) for p in self.params]
+        self.exp_avg_sq = [torch.zeros_like(p) for p in self.params]
+
+    def zero_grad(self):
+        for p in self.params:
+            p.grad = None
+
+    @torch.no_grad()
+    def step(self, mask):
+        # the moments and the parameters of the problems out of the mask are updated with zero weights
+        beta1, beta2 = self.betas
+        self.steps += mask
+        steps = torch.clamp(self.steps, min=1)
+        step_size = mask * self.lr / (1 - beta1 ** steps)
+        bias_correction2_sqrt = (1 - beta2 ** steps).sqrt()
+        weight1 = (1 - beta1) * mask
+        weight2 = (1 - beta2) * mask
+        decay2 = 1 - weight2
+        for p, exp_avg, exp_avg_sq in zip(self.params, self.exp_avg, self.exp_avg_sq):
+            if p.grad is None:
+                continue
+            shape = (-1,) + (1,) * (p.dim() - 1)
+            g = p.grad
+            exp_avg.lerp_(g, weight1.view(shape))
+            exp_avg_sq.mul_(decay2.view(shape)).addcmul_(g * weight2.view(shape), g)
+            denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt.view(shape)).add_(self.eps)
+            p.addcdiv_(exp_avg * step_size.view(shape), denom, value=-1)
+
+    def reset(self, k):
+        self.steps[k] = 0
+        for exp_avg, exp_avg_sq in zip(self.exp_avg, self.exp_avg_sq):
+            exp_avg[k] = 0
+            exp_avg_sq[k] = 0
+
+    def member_state_dict(self, k):
+        return {'step': self.steps[k].clone(),
+                'exp_avg': [exp_avg[k].clone() for exp_avg in self.exp_avg],
+                'exp_avg_sq': [exp_avg_sq[k].clone() for exp_avg_sq in self.exp_avg_sq]}
+
+    def load_member_state_dict(self, k, state):
+        self.steps[k] = state['step']
+        for exp_avg, value in zip(self.exp_avg, state['exp_avg']):
+            exp_avg[k] = value
+        for exp_avg_sq, value in zip(self.exp_avg_sq, state['exp_avg_sq']):
+            exp_avg_sq[k] = value
+
+
+class StackedAdamMember(object):
+
+    # the optimizer of a single problem of a StackedAdam
+
+    def __init__(self, optimizer, k):
+        self.optimizer = optimizer
+        self.k = k
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def step(self):
+        mask = torch.zeros_like(self.optimizer.steps)
+        mask[self.k] = 1
+        self.optimizer.step(mask)
+
+    def reset(self):
+        self.optimizer.reset(self.k)
+
+    def state_dict(self):
+        return self.optimizer.member_state_dict(self.k)
+
+    def load_state_dict(self, state):
+        self.optimizer.load_member_state_dict(self.k, state)
+
 class PiNet(nn.Module):
 
     def __init__(self, init, device, action_space):
@@ -0,0 +1,64 @@
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bbob import BBOBProblem
+
+# Local stand-in for a remote simulator: answers POST {"id": problem_id, "x": [...]} with {"f": value}
+# after an artificial latency.
+
+
+class ObjectiveHandler(BaseHTTPRequestHandler):
+
+    problems = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            with self.lock:
+                if request['id'] not in self.problems:
+                    self.problems[request['id']] = BBOBProblem.from_id(request['id'])
+                problem = self.problems[request['id']]
+            time.sleep(self.server.delay)
+            body = json.dumps({'f': float(problem(request['x']))}).encode()
+            self.send_response(200)
+        except Exception as e:
+            body = json.dumps({'error': str(e)}).encode()
+            self.send_response(400)
+
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ObjectiveServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections of a concurrent exploration batch
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that timed out close the connection before the answer is written
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(ObjectiveServer, self).handle_error(request, client_address)
+
+
+def serve(host='127.0.0.1', port=8765, delay=0.):
+    server = ObjectiveServer((host, port), ObjectiveHandler)
+    server.delay = delay
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='bbob objective server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Listening address')
+    parser.add_argument('--port', type=int, default=8765, help='Listening port')
+    parser.add_argument('--delay', type=float, default=0., help='Seconds of latency added to every evaluation')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.delay).serve_forever()
@@ -0,0 +1,65 @@
+import torch
+
+
+class ReplayBuffer(object):
+
+    # Fixed capacity circular buffer of exploration batches. The capacity is a multiple of the group size
+    # and whole groups are inserted, so group g always occupies the rows [g * group_size, (g + 1) * group_size)
+    # of the valid rows, whatever the insertion order.
+
+    def __init__(self, capacity, dim, group_size, device, dtype=torch.float):
+        assert capacity % group_size == 0, "capacity {} is not a multiple of the group size {}".format(capacity, group_size)
+        self.capacity = capacity
+        self.group_size = group_size
+        self.policy = torch.zeros(capacity, dim, dtype=dtype, device=device)
+        self.reward = torch.zeros(capacity, dtype=dtype, device=device)
+        self.step = torch.zeros(capacity, dtype=torch.int64, device=device)
+        self.size = 0
+        self.index = 0
+        self.steps = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, policy, reward):
+        n = len(reward)
+        assert n % self.group_size == 0, "{} rows are not whole groups of {}".format(n, self.group_size)
+        if n > self.capacity:
+            policy, reward = policy[-self.capacity:], reward[-self.capacity:]
+            self.steps += (n - self.capacity) // self.group_size
+            n = self.capacity
+
+        step = self.steps + torch.arange(n, device=self.step.device) // self.group_size
+        first = min(n, self.capacity - self.index)
+        with torch.no_grad():
+            for dst, src in ((self.policy, policy), (self.reward, reward), (self.step, step)):
+                dst[self.index:self.index + first] = src[:first]
+                dst[:n - first] = src[first:]
+
+        self.index = (self.index + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.steps += n // self.group_size
+
+    def state_dict(self):
+        return {'policy': self.policy, 'reward': self.reward, 'step': self.step,
+                'size': self.size, 'index': self.index, 'steps': self.steps}
+
+    def load_state_dict(self, state):
+        with torch.no_grad():
+            for dst, src in ((self.policy, state['policy']), (self.reward, state['reward']), (self.step, state['step'])):
+                dst.copy_(src)
+        self.size, self.index, self.steps = state['size'], state['index'], state['steps']
+
+    def policies(self):
+        return self.policy[:self.size]
+
+    def rewards(self):
+        return self.reward[:self.size]
+
+    def step_ids(self):
+        return self.step[:self.size]
+
+    def remap(self, f):
+        with torch.no_grad():
+            policy = self.policies()
+            policy.copy_(f(policy))
@@ -0,0 +1,172 @@
+import torch
+
+# Exploration samplers. A sampler draws the random part of an exploration batch: points of the cube [-1, 1]^d for
+# the rand exploration, unit directions with magnitudes in [0, 1) for the ball and cone explorations.
+# --explore is [sobol|halton][-pool][-antithetic]-(ball|cone|rand), without modifiers the samples are the
+# independent draws of the global generator.
+
+
+class GaussianSampler(object):
+
+    def __init__(self, dim, device, dtype=torch.float):
+        self.dim = dim
+        self.device = device
+        self.dtype = dtype
+
+    def cube(self, n):
+        sign = 2 * torch.randint(0, 2, size=(n, self.dim), device=self.device) - 1
+        return sign * torch.rand(n, self.dim, dtype=self.dtype, device=self.device)
+
+    def ball(self, n):
+        x = torch.randn(n, self.dim, dtype=self.dtype, device=self.device)
+        mag = torch.rand(n, 1, dtype=self.dtype, device=self.device)
+        return x / (torch.norm(x, dim=1, keepdim=True) + 1e-8), mag
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        return
+
+
+class QuasiRandomSampler(GaussianSampler):
+
+    # Scrambled Sobol or Halton points of [0, 1)^(d+1), successive batches continue the sequence. The directions are
+    # the normalized inverse normal CDF of the first d coordinates and the last coordinate is the magnitude.
+
+    def __init__(self, dim, device, dtype=torch.float, engine='sobol'):
+        super(QuasiRandomSampler, self).__init__(dim, device, dtype)
+        self.engine_name = engine
+        self.seed = int(torch.randint(2 ** 31, (1,)))
+        self.reset()
+
+    def reset(self):
+        if self.engine_name == 'sobol':
+            self.engine = torch.quasirandom.SobolEngine(self.dim + 1, scramble=True, seed=self.seed)
+        elif self.engine_name == 'halton':
+            from scipy.stats import qmc
+            self.engine = qmc.Halton(self.dim + 1, scramble=True, seed=self.seed)
+        else:
+            raise NotImplementedError
+        self.generated = 0
+
+    def uniform(self, n):
+        if not n:
+            return torch.zeros(0, self.dim + 1, dtype=torch.float64)
+        if self.engine_name == 'sobol':
+            u = self.engine.draw(n, dtype=torch.float64)
+        else:
+            u = torch.from_numpy(self.engine.random(n))
+        self.generated += n
+        # away from 0 and 1 where the inverse normal CDF diverges
+        return u.clamp(1e-10, 1 - 1e-10)
+
+    def cube(self, n):
+        u = self.uniform(n)[:, :self.dim]
+        return (2 * u - 1).to(device=self.device, dtype=self.dtype)
+
+    def ball(self, n):
+        u = self.uniform(n)
+        x = torch.erfinv(2 * u[:, :self.dim] - 1)
+        x = x / (torch.norm(x, dim=1, keepdim=True) + 1e-8)
+        return x.to(device=self.device, dtype=self.dtype), u[:, self.dim:].to(device=self.device, dtype=self.dtype)
+
+    def state_dict(self):
+        return {'seed': self.seed, 'generated': self.generated}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.reset()
+        if state['generated']:
+            self.engine.fast_forward(state['generated'])
+        self.generated = state['generated']
+
+
+class PoolSampler(object):
+
+    # A pool of samples drawn once from the base sampler. A batch is a window of consecutive pool rows at a random
+    # offset under a random orthogonal transform that keeps the shape: a signed permutation of the coordinates, for
+    # the ball followed by a Householder reflection of a random direction. The transform costs O(n d) instead of the
+    # O(d^3) of a uniform rotation, and a low discrepancy pool keeps its structure.
+
+    def __init__(self, base, size):
+        self.base = base
+        self.size = size
+        self.dim = base.dim
+        self.device = base.device
+        self.dtype = base.dtype
+        self.points = None
+        self.directions = None
+        self.mags = None
+
+    def window(self, n):
+        offset = torch.randint(self.size, (1,), device=self.device)
+        return (offset + torch.arange(n, device=self.device)) % self.size
+
+    def signed_permutation(self, x):
+        permutation = torch.randperm(self.dim, device=self.device)
+        sign = 2 * torch.randint(0, 2, size=(1, self.dim), device=self.device) - 1
+        return sign * x[:, permutation]
+
+    def cube(self, n):
+        if self.points is None:
+            self.points = self.base.cube(self.size)
+        return self.signed_permutation(self.points[self.window(n)])
+
+    def ball(self, n):
+        if self.directions is None:
+            self.directions, self.mags = self.base.ball(self.size)
+        index = self.window(n)
+        x = self.signed_permutation(self.directions[index])
+        v = torch.randn(self.dim, dtype=self.dtype, device=self.device)
+        v = v / torch.norm(v)
+        return x - 2 * (x @ v).unsqueeze(1) * v, self.mags[index]
+
+    def state_dict(self):
+        return {'base': self.base.state_dict(), 'points': self.points, 'directions': self.directions, 'mags': self.mags}
+
+    def load_state_dict(self, state):
+        self.base.load_state_dict(state['base'])
+        self.points, self.directions, self.mags = state['points'], state['directions'], state['mags']
+
+
+class AntitheticSampler(object):
+
+    # the samples come in pairs x, -x: reflected through pi in the ball and around the gradient axis in the cone
+
+    def __init__(self, base):
+        self.base = base
+        self.dim = base.dim
+
+    def cube(self, n):
+        x = self.base.cube((n + 1) // 2)
+        return torch.cat([x, -x])[:n]
+
+    def ball(self, n):
+        x, mag = self.base.ball((n + 1) // 2)
+        return torch.cat([x, -x])[:n], torch.cat([mag, mag])[:n]
+
+    def state_dict(self):
+        return {'base': self.base.state_dict()}
+
+    def load_state_dict(self, state):
+        self.base.load_state_dict(state['base'])
+
+
+def build_sampler(explore, dim, device, dtype=torch.float, pool=1024):
+    modifiers = set(explore.split('-')[:-1])
+    if not modifiers <= {'sobol', 'halton', 'pool', 'antithetic'} or {'sobol', 'halton'} <= modifiers:
+        raise NotImplementedError("explore sampler: " + explore)
+
+    if 'sobol' in modifiers:
+        sampler = QuasiRandomSampler(dim, device, dtype, engine='sobol')
+    elif 'halton' in modifiers:
+        sampler = QuasiRandomSampler(dim, device, dtype, engine='halton')
+    else:
+        sampler = GaussianSampler(dim, device, dtype)
+
+    if 'pool' in modifiers:
+        sampler = PoolSampler(sampler, pool)
+    if 'antithetic' in modifiers:
+        sampler = AntitheticSampler(sampler)
+    return sampler
@@ -5,7 +5,8 @@ import torch.optim.lr_scheduler
 import numpy as np
 from tqdm import tqdm
 import torch.autograd as autograd
-from model_ddpg import RobustNormalizer2, RobustNormalizer, NoRobustNormalizer, TrustRegion, NoTrustRegion
+from analysis_store import AnalysisWriter
+from model_ddpg import RobustNormalizer2, RobustNormalizer, NoRobustNormalizer, TrustRegion, NoTrustRegion, CompiledStep, EarlyStopping
 
 import itertools
 from agent import Agent
@@ -16,6 +17,7 @@ class TrustRegionAgent(Agent):
 
     def __init__(self, exp_name, env, checkpoint):
         super(TrustRegionAgent, self).__init__(exp_name, env, checkpoint)
+        self.analysis = AnalysisWriter(self.analysis_dir)
         reward_str = "TrustRegion"
         print("Learning POLICY method using {} with TrustRegionAgent".format(reward_str))
 
@@ -25,13 +27,17 @@ class TrustRegionAgent(Agent):
             self.pi_trust_region = NoTrustRegion(self.pi_net)
 
         if args.r_norm_alg == 'log':
-            self.r_norm = RobustNormalizer2(lr=args.robust_scaler_lr)
+            self.r_norm = RobustNormalizer2(lr=args.robust_scaler_lr, device=self.device, sketch=args.r_norm_sketch)
         elif args.r_norm_alg == 'none':
             self.r_norm = NoRobustNormalizer()
         else:
-            self.r_norm = RobustNormalizer(lr=args.robust_scaler_lr)
+            self.r_norm = RobustNormalizer(lr=args.robust_scaler_lr, device=self.device, sketch=args.r_norm_sketch)
 
-        if self.algorithm_method == 'EGL':
+        if self.algorithm_method == 'EGL' and args.egl_pairs:
+            if self.ensemble > 1:
+                raise NotImplementedError("ensembles are trained with a single EGL reference")
+            self.value_optimize_method = self.EGL_pairs_method_optimize
+        elif self.algorithm_method == 'EGL':
             self.value_optimize_method = self.EGL_method_optimize
         elif self.algorithm_method in ['IGL']:
             self.value_optimize_method = self.IGL_method_optimize
@@ -40,20 +46,33 @@ class TrustRegionAgent(Agent):
 
         self.best_pi = self.pi_net.pi.detach().clone()
         self.best_pi_evaluate = self.step_policy(self.best_pi, to_env=False)
-        self.best_reward = self.best_pi_evaluate*torch.cuda.FloatTensor(1)
+        self.best_reward = torch.tensor([self.best_pi_evaluate], dtype=self.dtype, device=self.device)
         self.f0 = self.best_pi_evaluate
         self.trust_region_con = args.trust_region_con
         self.min_iter = args.min_iter
         self.no_change = 0
         self.pertub = args.pertub
+        self.egl_pairs = min(args.egl_pairs, self.n_explore - 1) if args.egl_pairs > 0 else self.n_explore - 1
+        self.off_diagonal = (~torch.eye(self.n_explore, dtype=torch.bool, device=self.device)).flatten().nonzero().squeeze(1)
+        self.IGL_step = CompiledStep(self.IGL_loss, self.value_zero_grad, args.compile)
+        self.EGL_step = CompiledStep(self.EGL_loss, self.derivative_zero_grad, args.compile)
+        self.EGL_pairs_step = CompiledStep(self.EGL_pairs_loss, self.derivative_zero_grad, args.compile)
+
+        self.early_stopping = None
+        self.validation = None
+        if args.early_stop_patience > 0:
+            self.early_stopping = EarlyStopping(args.early_stop_patience, args.early_stop_min, args.early_stop_delta)
+            self.holdout = args.early_stop_holdout
 
     def update_replay_buffer(self):
 
-        # self.tensor_replay_reward = torch.cuda.FloatTensor([])
-        # self.tensor_replay_policy = torch.cuda.FloatTensor([])
+        # keep whole exploration groups, the EGL reference indexes rely on them
+        n_explore = self.explore_budget(self.warmup_minibatch*self.n_explore) // self.n_explore * self.n_explore
+        if not n_explore:
+            return
 
-        self.frame += self.warmup_minibatch*self.n_explore
-        explore_policies_rand = self.ball_explore(self.warmup_minibatch*self.n_explore)
+        self.frame += n_explore
+        explore_policies_rand = self.ball_explore(n_explore)
 
         self.step_policy(explore_policies_rand)
         rewards_rand = self.env.reward
@@ -68,8 +87,7 @@ class TrustRegionAgent(Agent):
         self.r_norm(rewards_rand, training=True)
         self.results['norm_rewards'].append(self.r_norm(rewards_rand, training=False))
 
-        self.tensor_replay_reward = torch.cat([self.tensor_replay_reward, rewards_rand])[-self.replay_memory_size:]
-        self.tensor_replay_policy = torch.cat([self.tensor_replay_policy, explore_policies_rand])[-self.replay_memory_size:]
+        self.replay.add(explore_policies_rand, rewards_rand)
 
     def results_pi_update_with_explore(self):
 
@@ -88,57 +106,48 @@ class TrustRegionAgent(Agent):
             val = self.r_norm.desquash(self.value_net(self.pi_net.pi.detach()).detach()).cpu().item()
             self.results['IGL'] = val
 
-        self.results['mean_grad'] = self.mean_grad.cpu().numpy()
+        # no pi step ran since a warmup that exhausted the budget
+        self.results['mean_grad'] = self.mean_grad.cpu().numpy() if self.mean_grad is not None else np.nan
         self.results['divergence'] = self.divergence
         self.results['r_norm_mean'] = self.r_norm.mu.detach().item()
         self.results['r_norm_sigma'] = self.r_norm.sigma.detach().item()
         self.results['min_trust_sigma'] = self.pi_trust_region.sigma.min().item()
+        if self.use_trust_region:
+            self.results['global_boundary'] = self.pi_trust_region.global_boundary.sum().item()
+            self.results['local_boundary'] = self.pi_trust_region.local_boundary.sum().item()
+        if self.ensemble > 1:
+            pi = self.pi_net.pi.detach()
+            if self.algorithm_method in ['EGL']:
+                self.results['ensemble_spread'] = torch.norm(self.derivative_net.spread(pi)).item()
+            else:
+                self.results['ensemble_spread'] = self.value_net.spread(pi).item()
         self.results['no_change'] = self.no_change
         self.results['epsilon'] = self.epsilon
+        if self.env.cache is not None:
+            self.results['cache_hits'] = self.env.cache.hits
 
         self.save_results()
 
     def save_results(self):
+        # every interval appends one chunk per series, read them back with analysis_store.load_series
         for k in self.results.keys():
-            path = os.path.join(self.analysis_dir, k + '.npy')
-            data_np = np.array([])
-            if os.path.exists(path):
-                data_np = np.load(path, allow_pickle=True)
-
-            if k in ['explore_policies']:
-                policy = (torch.cat(self.results[k], dim=0)).cpu().numpy()
-                if len(data_np):
-                    policy = np.concatenate([data_np, policy])
-                np.save(path, policy)
+            if k in ['explore_policies', 'rewards', 'norm_rewards']:
+                data = torch.cat(self.results[k], dim=0).cpu().numpy()
             elif k in ['policies']:
-                policy = (torch.stack(self.results[k])).cpu().numpy()
-                if len(data_np):
-                    policy = np.concatenate([data_np, policy])
-                np.save(path, policy)
-            elif k in ['reward_pi_evaluate', 'frame_pi_evaluate']:
-                rewards = self.results[k]
-                if len(data_np):
-                    rewards = np.concatenate([data_np, rewards])
-                np.save(path, rewards)
-            elif k in ['rewards', 'norm_rewards']:
-                rewards = torch.cat(self.results[k]).cpu().numpy()
-                if len(data_np):
-                    rewards = np.hstack([data_np, rewards])
-                np.save(path, rewards)
+                data = torch.stack(self.results[k]).cpu().numpy()
             elif k in ['grad']:
-                grad = self.results[k]
-                if len(data_np):
-                    grad = np.concatenate([data_np, grad])
-                np.save(path, grad)
+                data = self.results[k]
+            elif isinstance(self.results[k], list):
+                data = np.asarray(self.results[k])
             else:
                 data = np.array([self.results[k]])
-                if len(data_np):
-                    data = np.hstack([data_np, data])
-                np.save(path, data)
+            self.analysis.append(k, data)
 
+        # only the evaluations since the last save
         best_list, observed_list, _ = self.env.get_observed_and_pi_list()
-        np.save(os.path.join(self.analysis_dir, 'best_list_with_explore.npy'), np.array(best_list))
-        np.save(os.path.join(self.analysis_dir, 'observed_list_with_explore.npy'), np.array(best_list))
+        for k, data in [('best_list_with_explore', best_list), ('observed_list_with_explore', observed_list)]:
+            self.analysis.append(k, data[self.analysis.length(k):])
+        self.analysis.flush()
 
         path = os.path.join(self.analysis_dir, 'f0.npy')
         np.save(path, self.f0)
@@ -147,79 +156,158 @@ class TrustRegionAgent(Agent):
         self.mean_grad = None
         self.r_norm.reset()
         self.update_replay_buffer()
-        self.value_optimize(self.value_iter)
+        if len(self.replay):
+            self.value_optimize(self.value_iter)
 
-    def save_and_print_results(self):
-        self.save_checkpoint(self.checkpoint, {'n': self.frame})
+    def state_dict(self):
+        state = super(TrustRegionAgent, self).state_dict()
+        state.update({'r_norm': self.r_norm.state_dict(),
+                      'trust_region': self.pi_trust_region.state_dict(),
+                      'best_pi': self.best_pi,
+                      'best_pi_evaluate': self.best_pi_evaluate,
+                      'best_reward': self.best_reward,
+                      'f0': self.f0,
+                      'no_change': self.no_change,
+                      'counter': self.counter,
+                      'analysis': self.analysis.index})
+        return state
+
+    def load_state_dict(self, state):
+        super(TrustRegionAgent, self).load_state_dict(state)
+        self.r_norm.load_state_dict(state['r_norm'])
+        self.pi_trust_region.load_state_dict(state['trust_region'])
+        self.best_pi = state['best_pi']
+        self.best_pi_evaluate = state['best_pi_evaluate']
+        self.best_reward = state['best_reward']
+        self.f0 = state['f0']
+        self.no_change = state['no_change']
+        self.counter = state['counter']
+        # the chunks saved after the checkpoint are overwritten
+        self.analysis.index = state['analysis']
+
+    def save_and_print_results(self, i=None, status=None):
+        # the checkpoint follows the results so that the analysis store of a resumed problem ends at the checkpoint
         self.results_pi_update_with_explore()
+        self.save_checkpoint({'n': self.frame, 'i': i, 'status': status})
 
-    def minimize(self):
-        counter = -1
+    def start(self):
+        self.counter = -1
         self.env.reset()
         self.reset_net()
         self.warmup()
-        for i in tqdm(itertools.count()):
-            counter += 1
-            pi_explore, reward = self.exploration_step()
-            self.results['explore_policies'].append(self.pi_trust_region.unconstrained_to_real(pi_explore))
-            self.results['rewards'].append(reward)
-            self.results['norm_rewards'].append(self.r_norm(reward, training=False))
 
-            pi = self.pi_net.pi.detach()
-            pi_eval = self.step_policy(pi, to_env=False)
-            self.results['reward_pi_evaluate'].append(pi_eval)
-            self.results['frame_pi_evaluate'].append(self.frame)
-            real_pi = self.pi_trust_region.unconstrained_to_real(pi)
-            self.results['policies'].append(real_pi)
+    def resume(self):
+        # continues right after the save of the checkpoint, returns the next iteration or None for a completed problem
+        aux = self.load_checkpoint(self.resume_checkpoint)
+        print("RESUMED frame = {} status = {}".format(self.frame, aux['status']))
+        if aux['status'] in ['finished', 'failed']:
+            return None
 
-            self.value_optimize(self.value_iter)
-            self.pi_optimize()
+        self.reset_result()
+        if aux['status'] == 'divergence':
+            self.warmup()
+        return aux['i'] + 1
 
-            if pi_eval < self.best_pi_evaluate:
-                self.no_change = 0
-                self.best_pi_evaluate = pi_eval
-            else:
-                self.no_change += 1
+    def minimize(self):
+        if self.resume_checkpoint is None:
+            first = 0
+            self.start()
+        else:
+            first = self.resume()
+            if first is None:
+                return
 
-            if pi_eval < self.best_reward:
-                self.best_reward = torch.cuda.FloatTensor(pi_eval)
-                self.best_pi = real_pi
+        for i in tqdm(itertools.count(first)):
+            step = self.explore_step()
+            if step is None:
+                break
 
-            if self.env.t:
-                self.save_and_print_results()
-                yield self.results
+            if len(self.replay):
+                self.value_optimize(self.value_iter)
+
+            status = self.policy_step(i, *step)
+            if status is None:
+                continue
+
+            self.save_and_print_results(i, status)
+            yield self.results
+            if status == 'finished':
                 print("FINISHED SUCCESSFULLY - FRAME %d" % self.frame)
                 break
-
-            elif self.frame >= self.budget:
-                self.save_and_print_results()
-                yield self.results
+            elif status == 'failed':
                 print("FAILED frame = {}".format(self.frame))
                 break
 
-            elif counter > self.min_iter and self.no_change > self.trust_region_con:
-                counter = 0
-                self.divergence += 1
-                self.reset_net()
-                self.update_best_pi()
-                self.save_and_print_results()
-                yield self.results
-                self.reset_result()
+            self.reset_result()
+            if status == 'divergence':
                 self.warmup()
 
-            elif (i+1) % self.printing_interval == 0:
-                self.save_and_print_results()
-                yield self.results
-                self.reset_result()
+    def explore_step(self):
+        # the first part of a minimize iteration, up to the surrogate training
+        self.counter += 1
+        n_explore = self.explore_budget(self.n_explore)
+        if not n_explore:
+            # only a warmup ran since the last save, after a divergence or with a budget below one warmup
+            print("BUDGET EXHAUSTED frame = {}".format(self.frame))
+            if self.results:
+                # the evaluations of that warmup are not saved yet, the problem ends as a failed one
+                self.save_and_print_results(status='failed')
+            return None
+
+        pi_explore, reward = self.exploration_step(n_explore)
+        self.results['explore_policies'].append(self.pi_trust_region.unconstrained_to_real(pi_explore))
+        self.results['rewards'].append(reward)
+        self.results['norm_rewards'].append(self.r_norm(reward, training=False))
+
+        pi = self.pi_net.pi.detach()
+        pi_eval = self.step_policy(pi, to_env=False)
+        self.results['reward_pi_evaluate'].append(pi_eval)
+        self.results['frame_pi_evaluate'].append(self.frame)
+        real_pi = self.pi_trust_region.unconstrained_to_real(pi)
+        self.results['policies'].append(real_pi)
+
+        return n_explore, pi_eval, real_pi
+
+    def policy_step(self, i, n_explore, pi_eval, real_pi):
+        # the second part of a minimize iteration, returns the reason to save the results or None
+        self.pi_optimize()
+
+        if pi_eval < self.best_pi_evaluate:
+            self.no_change = 0
+            self.best_pi_evaluate = pi_eval
+        else:
+            self.no_change += 1
+
+        if pi_eval < self.best_reward:
+            self.best_reward = torch.tensor([pi_eval], dtype=self.dtype, device=self.device)
+            self.best_pi = real_pi
+
+        if self.env.t:
+            return 'finished'
+
+        elif self.frame >= self.budget or n_explore < self.n_explore or not self.explore_budget(self.n_explore):
+            return 'failed'
+
+        elif self.counter > self.min_iter and self.no_change > self.trust_region_con:
+            self.counter = 0
+            self.divergence += 1
+            self.reset_net()
+            self.update_best_pi()
+            return 'divergence'
+
+        elif (i+1) % self.printing_interval == 0:
+            return 'print'
+
+        return None
 
     def update_best_pi(self):
         pi = self.best_pi.detach().clone()
-        real_replay = self.pi_trust_region.unconstrained_to_real(self.tensor_replay_policy)
+        self.replay.remap(self.pi_trust_region.unconstrained_to_real)
         self.pi_trust_region.squeeze(pi)
         self.epsilon *= self.epsilon_factor
         self.epsilon = max(self.epsilon, 1e-4)
         self.pi_net.pi_update(self.pi_trust_region.real_to_unconstrained(pi))
-        self.tensor_replay_policy = self.pi_trust_region.real_to_unconstrained(real_replay)
+        self.replay.remap(self.pi_trust_region.real_to_unconstrained)
 
     def pi_optimize(self):
 
@@ -236,90 +324,241 @@ class TrustRegionAgent(Agent):
 
     def value_optimize(self, value_iter):
 
-        self.tensor_replay_reward_norm = self.r_norm(self.tensor_replay_reward)
-        self.tensor_replay_policy_norm = self.tensor_replay_policy
+        self.tensor_replay_reward_norm = self.r_norm(self.replay.rewards())
+        self.tensor_replay_policy_norm = self.replay.policies()
+
+        if self.early_stopping is not None:
+            self.hold_out()
 
         len_replay_buffer = len(self.tensor_replay_reward_norm)
         self.batch = min(self.max_batch, len_replay_buffer)
         minibatches = len_replay_buffer // self.batch
 
-        self.value_optimize_method(len_replay_buffer, minibatches, value_iter)
+        iterations = self.value_optimize_method(len_replay_buffer, minibatches, value_iter)
+        self.results['value_iterations'].append(iterations)
+
+    def hold_out(self):
+        # whole exploration groups are held out, the training rows keep the group layout of the replay
+        n_explore = self.n_explore
+        groups = len(self.tensor_replay_reward_norm) // n_explore
+        held_out = int(groups * self.holdout)
+        self.early_stopping.reset()
+        self.validation = None
+        if not held_out or held_out == groups:
+            return
+
+        group_index = torch.randperm(groups, generator=self.generator, device=self.device)
+        rows = (n_explore * group_index.unsqueeze(1) + torch.arange(n_explore, device=self.device)).flatten()
+        r = self.tensor_replay_reward_norm[rows[:held_out * n_explore]]
+        pi = self.tensor_replay_policy_norm[rows[:held_out * n_explore]]
+        self.tensor_replay_reward_norm = self.tensor_replay_reward_norm[rows[held_out * n_explore:]]
+        self.tensor_replay_policy_norm = self.tensor_replay_policy_norm[rows[held_out * n_explore:]]
+
+        # the held-out pairs are fixed for the whole training so the losses of the iterations are comparable
+        if self.algorithm_method == 'IGL':
+            self.validation = (self.IGL_loss, (pi, r))
+        elif args.egl_pairs:
+            r = r.view(held_out, n_explore)
+            pi = pi.view(held_out, n_explore, self.action_space)
+            ref_index = None if self.egl_pairs == n_explore - 1 else self.sample_references(r.shape)
+            group_range = torch.arange(held_out, device=self.device).view(-1, 1, 1)
+            self.validation = (self.EGL_pairs_loss, (pi, pi, r, ref_index, group_range))
+        else:
+            ref_index = torch.randint(n_explore, r.shape, generator=self.generator, device=self.device)
+            ref_index += n_explore * (torch.arange(len(r), device=self.device) // n_explore)
+            self.validation = (self.EGL_loss, (pi, pi, pi[ref_index], r, r[ref_index]))
+
+    def converged(self):
+        if self.validation is None:
+            return False
+        loss_function, validation_args = self.validation
+        with torch.no_grad():
+            loss = loss_function(*validation_args).item()
+        return self.early_stopping(loss)
+
+    def value_zero_grad(self):
+        self.optimizer_value.zero_grad()
+        self.optimizer_pi.zero_grad()
+
+    def derivative_zero_grad(self):
+        self.optimizer_derivative.zero_grad()
+        self.optimizer_pi.zero_grad()
 
     def IGL_method_optimize(self, len_replay_buffer, minibatches, value_iter):
         loss = 0
+        iterations = 0
         self.value_net.train()
         for _ in range(value_iter):
-            shuffle_indexes = np.random.choice(len_replay_buffer, (minibatches, self.batch), replace=False)
+            iterations += 1
+            samples = self.sample_minibatches(len_replay_buffer, minibatches)
+            rewards = self.tensor_replay_reward_norm[samples]
+            policies = self.tensor_replay_policy_norm[samples]
             for i in range(minibatches):
-                samples = shuffle_indexes[i]
-                r = self.tensor_replay_reward_norm[samples]
-                pi_explore = self.tensor_replay_policy_norm[samples]
-
                 self.optimizer_value.zero_grad()
                 self.optimizer_pi.zero_grad()
-                q_value = self.value_net(pi_explore).flatten()
-                if self.spline:
-                    loss_q = self.q_loss(q_value, r).sum()
-                else:
-                    loss_q = self.q_loss(q_value, r).mean()
-                loss += loss_q.detach().item()
-                loss_q.backward()
+                loss_q = self.IGL_step(policies[i], rewards[i])
+                loss += loss_q
                 self.optimizer_value.step()
 
-        loss /= value_iter
+            if self.converged():
+                break
+
+        loss = float(loss) / iterations / self.ensemble
         self.results['value_loss'].append(loss)
         self.value_net.eval()
+        return iterations
 
     def ball_perturb(self, pi, eps):
 
-        n_explore = len(pi)
+        if not eps:
+            return pi
 
-        x = torch.cuda.FloatTensor(n_explore, self.action_space).normal_()
-        mag = torch.cuda.FloatTensor(n_explore, 1).uniform_()
+        x = torch.randn(pi.shape, generator=self.generator, dtype=self.dtype, device=self.device)
+        mag = torch.rand(pi.shape[:-1] + (1,), generator=self.generator, dtype=self.dtype, device=self.device)
 
-        x = x / (torch.norm(x, dim=1, keepdim=True) + 1e-8)
+        x = x / (torch.norm(x, dim=-1, keepdim=True) + 1e-8)
 
         explore = pi + eps * mag * x
 
         return explore
 
+    def sample_minibatches(self, len_replay_buffer, minibatches):
+        if self.ensemble > 1:
+            # every member of an ensemble has its own permutation, minibatch i is members x batch
+            scores = torch.rand(self.ensemble, len_replay_buffer, generator=self.generator, device=self.device)
+            samples = scores.argsort(dim=1)[:, :minibatches * self.batch]
+            return samples.view(self.ensemble, minibatches, self.batch).transpose(0, 1)
+        # disjoint minibatches of a single permutation, as np.random.choice(..., replace=False) gave
+        samples = torch.randperm(len_replay_buffer, generator=self.generator, device=self.device)
+        return samples[:minibatches * self.batch].view(minibatches, self.batch)
+
     def EGL_method_optimize(self, len_replay_buffer, minibatches, value_iter):
 
         loss = 0
+        iterations = 0
         self.derivative_net.train()
         for _ in range(value_iter):
-            anchor_indexes = np.random.choice(len_replay_buffer, (minibatches, self.batch), replace=False)
-            ref_indexes = np.random.randint(0, self.n_explore, size=(minibatches, self.batch))
-            explore_indexes = anchor_indexes // self.n_explore
+            iterations += 1
+            # the reference of every anchor is drawn from the exploration group of the anchor
+            anchor_index = self.sample_minibatches(len_replay_buffer, minibatches)
+            ref_index = torch.randint(self.n_explore, anchor_index.shape, generator=self.generator, device=self.device)
+            ref_index += self.n_explore * (anchor_index // self.n_explore)
+
+            r_1 = self.tensor_replay_reward_norm[anchor_index]
+            r_2 = self.tensor_replay_reward_norm[ref_index]
+            pi_1 = self.tensor_replay_policy_norm[anchor_index]
+            pi_2 = self.tensor_replay_policy_norm[ref_index]
+            pi_1_perturb = self.ball_perturb(pi_1, eps=self.epsilon*self.pertub)
 
-            for i, anchor_index in enumerate(anchor_indexes):
-                ref_index = torch.LongTensor(self.n_explore * explore_indexes[i] + ref_indexes[i])
+            for i in range(minibatches):
+                self.optimizer_derivative.zero_grad()
+                self.optimizer_pi.zero_grad()
+                loss_q = self.EGL_step(pi_1_perturb[i], pi_1[i], pi_2[i], r_1[i], r_2[i])
+
+                loss += loss_q
+                self.optimizer_derivative.step()
+
+            if self.converged():
+                break
+
+        loss = float(loss) / iterations / self.ensemble
+        self.results['derivative_loss'] = loss
+        self.derivative_net.eval()
+        return iterations
+
+    def surrogate_members(self, net, pi):
+        # the predictions of every member of an ensemble, pi holds a minibatch per member or a shared one
+        if self.ensemble > 1:
+            return net.members(pi)
+        return net(pi)
+
+    def reduce_loss(self, loss_q):
+        # the members of an ensemble are trained as separate models, their losses are summed
+        if self.spline:
+            return loss_q.sum()
+        return loss_q.mean(dim=-1).sum()
 
-                r_1 = self.tensor_replay_reward_norm[anchor_index]
-                r_2 = self.tensor_replay_reward_norm[ref_index]
-                pi_1 = self.tensor_replay_policy_norm[anchor_index]
-                pi_1_perturb = self.ball_perturb(pi_1, eps=self.epsilon*self.pertub)
+    def IGL_loss(self, policies, rewards):
+        q_value = self.surrogate_members(self.value_net, policies).view(self.ensemble_shape + rewards.shape[-1:])
+        return self.reduce_loss(self.q_loss(q_value, rewards.expand_as(q_value)))
 
-                pi_2 = self.tensor_replay_policy_norm[ref_index]
-                pi_tag_1 = self.derivative_net(pi_1_perturb)
+    def EGL_loss(self, pi_1_perturb, pi_1, pi_2, r_1, r_2):
+        pi_tag_1 = self.surrogate_members(self.derivative_net, pi_1_perturb)
 
-                value = ((pi_2 - pi_1) * pi_tag_1).sum(dim=1)
-                target = (r_2 - r_1)
+        value = ((pi_2 - pi_1) * pi_tag_1).sum(dim=-1)
+        target = (r_2 - r_1).expand_as(value)
 
+        return self.reduce_loss(self.q_loss(value, target))
+
+    def EGL_pairs_loss(self, pi_perturb, pi, r, ref_index, group_range):
+        pi_tag = self.derivative_net(pi_perturb.view(-1, self.action_space)).view_as(pi)
+
+        if ref_index is None:
+            # value[g, a, b] = (pi_b - pi_a) * pi_tag_a
+            value = pi_tag @ pi.transpose(1, 2) - (pi * pi_tag).sum(dim=2, keepdim=True)
+            target = r.unsqueeze(1) - r.unsqueeze(2)
+            value = value.flatten(1)[:, self.off_diagonal]
+            target = target.flatten(1)[:, self.off_diagonal]
+        else:
+            pi_2 = pi[group_range, ref_index]
+            value = ((pi_2 - pi.unsqueeze(2)) * pi_tag.unsqueeze(2)).sum(dim=3)
+            target = r[group_range, ref_index] - r.unsqueeze(2)
+
+        # averaged over the references of each anchor to keep the scale of the single reference loss
+        loss_q = self.q_loss(value, target).view(-1, self.egl_pairs).mean(dim=1)
+        if self.spline:
+            return loss_q.sum()
+        return loss_q.mean()
+
+    def EGL_pairs_method_optimize(self, len_replay_buffer, minibatches, value_iter):
+
+        # the replay is made of whole exploration groups, a minibatch holds batch // n_explore groups and every
+        # anchor is paired with all the other members of its group, or with egl_pairs of them
+        n_explore = self.n_explore
+        groups = len_replay_buffer // n_explore
+        group_batch = min(max(self.batch // n_explore, 1), groups)
+        minibatches = groups // group_batch
+        all_pairs = self.egl_pairs == n_explore - 1
+
+        rewards = self.tensor_replay_reward_norm.view(groups, n_explore)
+        policies = self.tensor_replay_policy_norm.view(groups, n_explore, self.action_space)
+        group_range = torch.arange(group_batch, device=self.device).view(-1, 1, 1)
+
+        loss = 0
+        iterations = 0
+        self.derivative_net.train()
+        for _ in range(value_iter):
+            iterations += 1
+            group_index = torch.randperm(groups, generator=self.generator, device=self.device)
+            group_index = group_index[:minibatches * group_batch].view(minibatches, group_batch)
+
+            r = rewards[group_index]
+            pi = policies[group_index]
+            pi_perturb = self.ball_perturb(pi, eps=self.epsilon*self.pertub)
+
+            ref_index = [None] * minibatches if all_pairs else self.sample_references(r.shape)
+
+            for i in range(minibatches):
                 self.optimizer_derivative.zero_grad()
                 self.optimizer_pi.zero_grad()
-                if self.spline:
-                    loss_q = self.q_loss(value, target).sum()
-                else:
-                    loss_q = self.q_loss(value, target).mean()
+                loss_q = self.EGL_pairs_step(pi_perturb[i], pi[i], r[i], ref_index[i], group_range)
 
-                loss += loss_q.detach().item()
-                loss_q.backward()
+                loss += loss_q
                 self.optimizer_derivative.step()
 
-        loss /= value_iter
+            if self.converged():
+                break
+
+        loss = float(loss) / iterations
         self.results['derivative_loss'] = loss
         self.derivative_net.eval()
+        return iterations
+
+    def sample_references(self, shape):
+        # distinct random references within the group of each anchor, the anchor itself scores lowest and is never drawn
+        scores = torch.rand(shape + (self.n_explore,), generator=self.generator, device=self.device)
+        scores.diagonal(dim1=-2, dim2=-1).fill_(-1)
+        return scores.topk(self.egl_pairs, dim=-1)[1]
 
     def step_policy(self, policy, to_env=True):
         policy = self.pi_trust_region.unconstrained_to_real(policy)
@@ -328,9 +567,14 @@ class TrustRegionAgent(Agent):
         else:
             return self.env.f(policy)
 
-    def exploration_step(self):
-        self.frame += self.n_explore
-        pi_explore = self.exploration(self.n_explore)
+    def explore_budget(self, n_explore):
+        # one evaluation of the env budget is kept for evaluating pi after the exploration
+        return max(min(n_explore, self.env.remaining_budget() - 1), 0)
+
+    def exploration_step(self, n_explore=None):
+        n_explore = self.n_explore if n_explore is None else n_explore
+        self.frame += n_explore
+        pi_explore = self.exploration(n_explore)
         self.step_policy(pi_explore)
         rewards = self.env.reward
 
@@ -342,10 +586,11 @@ class TrustRegionAgent(Agent):
             self.best_pi = self.pi_trust_region.unconstrained_to_real(pi_explore[best_explore].detach().clone())
             self.best_reward = rewards[best_explore]
 
-        self.r_norm(rewards, training=True)
-
-        self.tensor_replay_reward = torch.cat([self.tensor_replay_reward, rewards])[-self.replay_memory_size:]
-        self.tensor_replay_policy = torch.cat([self.tensor_replay_policy, pi_explore])[-self.replay_memory_size:]
+        # a trimmed last batch would break the exploration groups the EGL reference indexes rely on
+        # and may be too small for the normalizer quantiles
+        if n_explore == self.n_explore:
+            self.r_norm(rewards, training=True)
+            self.replay.add(pi_explore, rewards)
 
         return pi_explore, rewards
 
@@ -354,7 +599,7 @@ class TrustRegionAgent(Agent):
         lower = min((self.pi_trust_region.mu - self.pi_trust_region.sigma).cpu().numpy(), -1)
         policy = np.clip(policy, a_min=lower, a_max=upper)
 
-        target = torch.FloatTensor(target)
+        target = torch.tensor(target, dtype=self.dtype, device=self.device)
 
         self.value_net.eval()
         batch = 1024
@@ -363,10 +608,10 @@ class TrustRegionAgent(Agent):
         for i in range(0, policy.shape[0], batch):
             from_index = i
             to_index = min(i + batch, policy.shape[0])
-            policy_tensor = torch.cuda.FloatTensor(policy[from_index:to_index])
+            policy_tensor = torch.tensor(policy[from_index:to_index], dtype=self.dtype, device=self.device)
             policy_tensor = self.pi_trust_region.real_to_unconstrained(policy_tensor)
             policy_tensor = autograd.Variable(policy_tensor, requires_grad=True)
-            target_tensor = torch.cuda.FloatTensor(target[from_index:to_index])
+            target_tensor = target[from_index:to_index]
             q_value = self.value_net(policy_tensor).view(-1)
             value.append(q_value.detach().cpu().numpy())
 
@@ -375,7 +620,7 @@ class TrustRegionAgent(Agent):
             else:
                 loss_q = self.q_loss(q_value, target_tensor).mean()
 
-            grads = autograd.grad(outputs=loss_q, inputs=policy_tensor, grad_outputs=torch.cuda.FloatTensor(loss_q.size()).fill_(1.),
+            grads = autograd.grad(outputs=loss_q, inputs=policy_tensor, grad_outputs=torch.ones_like(loss_q),
                                       create_graph=True, retain_graph=True, only_inputs=True)[0].detach()
             grads_norm.append(torch.norm(torch.clamp(grads.view(-1, self.action_space), -1, 1), p=2, dim=1).cpu().numpy())
 
@@ -392,9 +637,9 @@ class TrustRegionAgent(Agent):
         lower = min((self.pi_trust_region.mu - self.pi_trust_region.sigma).cpu().numpy(), -1)
         policy = np.clip(policy, a_min=lower, a_max=upper)
 
-        f = torch.FloatTensor(f)
+        f = torch.tensor(f, dtype=self.dtype, device=self.device)
         self.derivative_net.eval()
-        policy_tensor = torch.cuda.FloatTensor(policy)
+        policy_tensor = torch.tensor(policy, dtype=self.dtype, device=self.device)
         policy_tensor = self.pi_trust_region.real_to_unconstrained(policy_tensor)
         policy_diff = policy_tensor[1:]-policy_tensor[:-1]
         policy_diff_norm = policy_diff / (torch.norm(policy_diff, p=2, dim=1, keepdim=True) + 1e-5)
@@ -14,6 +14,7 @@ import pathlib
 import socket
 from tqdm import tqdm
 from config import consts
+from bbob import BBOBProblem
 
 class VAE(nn.Module):
     def __init__(self, vae_mode):
@@ -73,7 +74,7 @@ class VaeModel(object):
     def __init__(self, vae_mode):
         root_dir = consts.vaedir
         self.vae_mode = vae_mode
-        is_cuda = torch.cuda.is_available()
+        is_cuda = not args.no_cuda and torch.cuda.is_available()
         torch.manual_seed(128)
         self.device = torch.device("cuda" if is_cuda else "cpu")
         kwargs = {'num_workers': 1, 'pin_memory': True} if is_cuda else {}
@@ -183,6 +184,8 @@ class VaeProblem(object):
     def reset(self, problem_index):
         self.suite.reset()
         self.problem = self.suite.get_problem(problem_index)
+        if args.bbob_engine == 'numpy':
+            self.problem = BBOBProblem.from_id(self.problem.id, index=self.problem.index)
 
         self.z_upper_bounds = self.problem.upper_bounds
         self.z_lower_bounds = self.problem.lower_bounds
@@ -216,14 +219,21 @@ class VaeProblem(object):
         return policy
 
     def func(self, x):
-        z, _, _, _ = self.vae.model(x.unsqueeze(0), 'enc')
-        z = z.detach().cpu().numpy()
+        return self.func_batch(x.view(1, -1))[0]
+
+    def func_batch(self, x):
+        with torch.no_grad():
+            z, _, _, _ = self.vae.model(x.to(self.device), 'enc')
+        z = z.cpu().numpy()
         #z = self.denormalize(z).flatten()
-        z = np.clip(z.flatten(), a_min=self.z_lower_bounds, a_max=self.z_upper_bounds)
-        f_val = self.problem(z)
+        z = np.clip(z, a_min=self.z_lower_bounds, a_max=self.z_upper_bounds)
+        if hasattr(self.problem, 'batch'):
+            f_val = self.problem.batch(z)
+        else:
+            f_val = np.array([self.problem(z[i]) for i in range(len(z))])
 
         self.best_observed_fvalue1 = self.problem.best_observed_fvalue1
-        self.evaluations += 1
+        self.evaluations += len(f_val)
         self.final_target_hit = self.problem.final_target_hit
 
         return f_val
@@ -23,6 +23,8 @@ from collections import defaultdict
 from vae import VaeProblem, VAE
 from environment import EnvCoco, EnvOneD, EnvVae
 from environment import one_d_change_dim
+from bbob import BBOBProblem
+from analysis_store import load_series
 import pickle
 username = pwd.getpwuid(os.geteuid()).pw_name
 from config import Consts
@@ -250,12 +252,9 @@ def treeD_plot_contour(problem_index):
     x0 = np.arange(lower_bound[0], upper_bound[0] + interval, interval)
     x1 = np.arange(lower_bound[1], upper_bound[1] + interval, interval)
     x0, x1 = np.meshgrid(x0, x1)
-    z = np.zeros(x0.shape)
 
-    for i in range(x0.shape[0]):
-        for j in range(x1.shape[1]):
-            x = np.array([x0[i,j], x1[i,j]])
-            z[i,j] = problem(x)
+    batch_problem = BBOBProblem.from_id(problem.id)
+    z = batch_problem.batch(np.stack([x0.flatten(), x1.flatten()], axis=1)).reshape(x0.shape)
 
     res_dir = os.path.join(Consts.baseline_dir, 'f_eval', '2D_Contour')
     if not os.path.exists(res_dir):
@@ -303,11 +302,9 @@ def nD_plot(dim, problem_index):
 
     norm_policy = np.arange(-1, 1 + interval, interval).reshape(-1,1)
     norm_policy = np.repeat(norm_policy, dim, axis=1)
-    f = np.zeros(norm_policy.shape[0])
     policy = 0.5 * (norm_policy + 1) * (upper_bound - lower_bound) + lower_bound
 
-    for i in range(policy.shape[0]):
-        f[i] = problem(policy[i])
+    f = BBOBProblem.from_id(problem.id).batch(policy)
 
     res_dir = os.path.join(Consts.baseline_dir, 'f_eval', '{}D'.format(dim))
     if not os.path.exists(res_dir):
@@ -468,7 +465,7 @@ def avg_dim_best_observed(dim, save_file, alg_name_list, prefix_list, with_op=Fa
                 tmp_id = []
                 for id in dir_index:
                     try:
-                        _ = np.load(os.path.join(compare_dirs[alg], id, 'best_list_with_explore.npy'), allow_pickle=True)
+                        _ = load_series(os.path.join(compare_dirs[alg], id), 'best_list_with_explore')
                     except:
                         continue
                     tmp_id.append(id)
@@ -484,7 +481,7 @@ def avg_dim_best_observed(dim, save_file, alg_name_list, prefix_list, with_op=Fa
 
         for key, path in compare_dirs.items():
             try:
-                pi_best = np.load(os.path.join(path, index, 'best_list_with_explore.npy'),  allow_pickle=True)
+                pi_best = load_series(os.path.join(path, index), 'best_list_with_explore')
                 min_val = min(min_val, pi_best.min())
             except:
                 pass
@@ -505,7 +502,7 @@ def avg_dim_best_observed(dim, save_file, alg_name_list, prefix_list, with_op=Fa
 
         for key in alg_name_list:
             try:
-                pi_best = np.load(os.path.join(compare_dirs[key], index, 'best_list_with_explore.npy'),  allow_pickle=True)
+                pi_best = load_series(os.path.join(compare_dirs[key], index), 'best_list_with_explore')
                 pi_best = np.clip(pi_best, a_max=f0, a_min=min_val)
                 pi_best = pi_best[:max_len]
                 pi_best = np.concatenate([pi_best, pi_best[-1] * np.ones(max_len - len(pi_best))])
@@ -614,7 +611,7 @@ def avg_perturb_best_observed(dim, save_file, div_name,alg_name_list, prefix_lis
                 tmp_id = []
                 for id in dir_index:
                     try:
-                        _ = np.load(os.path.join(compare_dirs[alg], id, 'best_list_with_explore.npy'), allow_pickle=True)
+                        _ = load_series(os.path.join(compare_dirs[alg], id), 'best_list_with_explore')
                     except:
                         continue
                     tmp_id.append(id)
@@ -630,13 +627,13 @@ def avg_perturb_best_observed(dim, save_file, div_name,alg_name_list, prefix_lis
 
         for key, path in compare_dirs.items():
             try:
-                pi_best = np.load(os.path.join(path, index, 'best_list_with_explore.npy'),  allow_pickle=True)
+                pi_best = load_series(os.path.join(path, index), 'best_list_with_explore')
                 min_val = min(min_val, pi_best.min())
             except:
                 pass
         for key, path in div_dirs.items():
             try:
-                pi_best = np.load(os.path.join(path, index, 'best_list_with_explore.npy'),  allow_pickle=True)
+                pi_best = load_series(os.path.join(path, index), 'best_list_with_explore')
                 min_val = min(min_val, pi_best.min())
             except:
                 pass
@@ -644,7 +641,7 @@ def avg_perturb_best_observed(dim, save_file, div_name,alg_name_list, prefix_lis
         min_val -= 1e-5
         for key in alg_name_list:
             try:
-                pi_best = np.load(os.path.join(compare_dirs[key], index, 'best_list_with_explore.npy'),  allow_pickle=True)
+                pi_best = load_series(os.path.join(compare_dirs[key], index), 'best_list_with_explore')
                 pi_best = np.clip(pi_best, a_max=f0, a_min=min_val)
                 pi_best = pi_best[:max_len]
                 pi_best = np.concatenate([pi_best, pi_best[-1] * np.ones(max_len - len(pi_best))])
@@ -728,7 +725,7 @@ def dim_plot(kk, alg_name_list, prefix_list, with_op, ax):
                 tmp_id = []
                 for id in dir_index:
                     try:
-                        _ = np.load(os.path.join(compare_dirs[alg], id, 'best_list_with_explore.npy'), allow_pickle=True)
+                        _ = load_series(os.path.join(compare_dirs[alg], id), 'best_list_with_explore')
                     except:
                         continue
                     tmp_id.append(id)
@@ -743,7 +740,7 @@ def dim_plot(kk, alg_name_list, prefix_list, with_op, ax):
         f0 = optimizer_res['f0'][0]
 
         for key, path in compare_dirs.items():
-            pi_best = np.load(os.path.join(path, index, 'best_list_with_explore.npy'), allow_pickle=True)
+            pi_best = load_series(os.path.join(path, index), 'best_list_with_explore')
             min_val = min(min_val, pi_best.min())
 
         min_val -= 1e-5
@@ -762,7 +759,7 @@ def dim_plot(kk, alg_name_list, prefix_list, with_op, ax):
 
         for key in alg_name_list:
             try:
-                pi_best = np.load(os.path.join(compare_dirs[key], index, 'best_list_with_explore.npy'), allow_pickle=True)
+                pi_best = load_series(os.path.join(compare_dirs[key], index), 'best_list_with_explore')
                 pi_best = np.clip(pi_best, a_max=f0, a_min=min_val)
                 pi_best = pi_best[:max_len]
                 pi_best = np.concatenate([pi_best, pi_best[-1] * np.ones(max_len - len(pi_best))])
@@ -966,7 +963,7 @@ def get_csv_from_run(optimizer, disp_name, dim):
             index = int(dir)
             id = '{}_bbob_f{:03d}_i{}_d{:02}'.format(prefix, f_num[index // 15], i_num[index % 15], max(dim_c, 2))
             path = os.path.join(res_dir, dir)
-            pi_best = np.load(os.path.join(path, 'best_list_with_explore.npy'), allow_pickle=True)
+            pi_best = load_series(path, 'best_list_with_explore')
         except:
             continue
         number_of_evaluations = len(pi_best)
@@ -1098,7 +1095,7 @@ def bbo_evaluate_compare(dim, index, prefix='CMP'):
     for i, key in enumerate(compare_dirs.keys()):
         path = compare_dirs[key]
         try:
-            pi_best = np.load(os.path.join(path, 'best_observed.npy'), allow_pickle=True)
+            pi_best = load_series(path, 'best_observed')
 
             bbo_min_val = min(bbo_min_val, pi_best.min())
             min_val = min(min_val, bbo_min_val)
@@ -1109,10 +1106,10 @@ def bbo_evaluate_compare(dim, index, prefix='CMP'):
     for i, key in enumerate(compare_dirs.keys()):
         path = compare_dirs[key]
         try:
-            pi_eval = np.load(os.path.join(path, 'reward_pi_evaluate.npy'), allow_pickle=True)
-            frame_eval = np.load(os.path.join(path, 'frame_pi_evaluate.npy'), allow_pickle=True)
-            pi_best = np.load(os.path.join(path, 'best_observed.npy'), allow_pickle=True)
-            frame = np.load(os.path.join(path, 'frame.npy'), allow_pickle=True)
+            pi_eval = load_series(path, 'reward_pi_evaluate')
+            frame_eval = load_series(path, 'frame_pi_evaluate')
+            pi_best = load_series(path, 'best_observed')
+            frame = load_series(path, 'frame')
 
             ax1.loglog(frame_eval, (pi_eval - min_val)/(f0 - min_val), color=colors[i], label=key)
             ax2.loglog(frame, (pi_best - min_val) / (f0 - min_val), color=colors[i])
@@ -1163,8 +1160,8 @@ def plot_2d_first_value():
         max_val = res['z'].max()
         res['z'] /= (max_val + 1e-3)
 
-        value_x = 5 * np.load(os.path.join(value_path, 'policies.npy'), allow_pickle=True)
-        first_order_x = 5 * np.load(os.path.join(first_order_path, 'policies.npy'), allow_pickle=True)
+        value_x = 5 * load_series(value_path, 'policies')
+        first_order_x = 5 * load_series(first_order_path, 'policies')
 
         cs = axs[j].contour(res['x0'], res['x1'], np.log(res['z']), 100)
 
@@ -1199,8 +1196,8 @@ def plot_2d_same_eps():
     res['z'] /= (max_val + 1e-3)
 
     e = []
-    e.append(5 * np.load(os.path.join(e1_path, 'policies.npy'), allow_pickle=True))
-    e.append(5 * np.load(os.path.join(e2_path, 'policies.npy'), allow_pickle=True))
+    e.append(5 * load_series(e1_path, 'policies'))
+    e.append(5 * load_series(e2_path, 'policies'))
 
 
     i=0
@@ -1238,10 +1235,10 @@ def plot_2d_first_divergance():
 
         cs = axs[j].contour(res['x0'], res['x1'], np.log(res['z']), 100)
 
-        first_order_x = 5 * np.load(os.path.join(first_order_path, 'policies.npy'), allow_pickle=True)
-        frame_policy = np.load(os.path.join(first_order_path, 'frame_pi_evaluate.npy'), allow_pickle=True)
-        divergence = np.load(os.path.join(first_order_path, 'divergence.npy'), allow_pickle=True)
-        frame = np.load(os.path.join(first_order_path, 'frame.npy'), allow_pickle=True)
+        first_order_x = 5 * load_series(first_order_path, 'policies')
+        frame_policy = load_series(first_order_path, 'frame_pi_evaluate')
+        divergence = load_series(first_order_path, 'divergence')
+        frame = load_series(first_order_path, 'frame')
 
         min = 0
         for i in set(divergence):
@@ -1364,8 +1361,8 @@ def plot_2d_first_value_and_divergance():
         res['z'] /= (max_val + 1e-3)
 
         e = []
-        e.append(5 * np.load(os.path.join(e1_path, 'policies.npy'), allow_pickle=True))
-        e.append(5 * np.load(os.path.join(e2_path, 'policies.npy'), allow_pickle=True))
+        e.append(5 * load_series(e1_path, 'policies'))
+        e.append(5 * load_series(e2_path, 'policies'))
 
         for i, e_x in enumerate(e):
             cs = axs[j].contour(res['x0'], res['x1'], np.log(res['z']), 100)
@@ -1398,8 +1395,8 @@ def plot_2d_first_value_and_divergance():
         max_val = res['z'].max()
         res['z'] /= (max_val + 1e-3)
 
-        value_x = 5 * np.load(os.path.join(value_path, 'policies.npy'), allow_pickle=True)
-        first_order_x = 5 * np.load(os.path.join(first_order_path, 'policies.npy'), allow_pickle=True)
+        value_x = 5 * load_series(value_path, 'policies')
+        first_order_x = 5 * load_series(first_order_path, 'policies')
 
         cs = axs[j].contour(res['x0'], res['x1'], np.log(res['z']), 100)
 